@@ -0,0 +1,238 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import synthetic_data
+
+"""
+Benchmark suite of the processing stages on synthetic data.
+For every scale, a data set is generated with synthetic_data and the stages are timed in a separate process
+that imports the data set's config.py. Results are written as JSON and compared against a baseline:
+a stage is a regression when it is slower than the baseline by more than the tolerance.
+
+Usage:
+python benchmark_suite.py --scales 10 100 1000 --repeat 3 --output results.json --baseline baseline.json
+--scales: Numbers of files per data set (default: 10 100 1000)
+--repeat: How many times each stage is repeated (the best time is reported)
+--data "data_path": Keep the generated data sets in data_path and reuse them on the next run (default: temporary)
+--output "output_path": Write the results to a .json file
+--baseline "baseline_path": Compare the results against an earlier results file, exits with code 1 on regressions
+--tolerance: Allowed slowdown relative to the baseline (default: 0.25 = 25%)
+"""
+
+SCALES = (10, 100, 1000)
+FORMATS = ("spe", "csv", "json")
+PEAK_WINDOW = (2700, 2790)  # Channels around the 2745 peak of synthetic_data.DEFAULT_PEAKS
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Imported by main.py at startup
+STARTUP_MODULES = ("gamma_spectrum", "directory_index", "export", "plotter", "instrumentation")
+
+# Run in the benchmark process: the data set directory goes first on sys.path, so its config.py is imported
+CHILD_COMMAND = "import sys; sys.path[:0] = sys.argv[1:3]; import benchmark_suite; benchmark_suite.run_child()"
+
+
+def time_stage(function, setup=None, repeat=3) -> float:
+    """
+    Best time of repeated calls in seconds
+    :param function: Called with the result of setup()
+    :param setup: Prepares the input of every repeat, not timed (e.g. copies of spectra modified in place)
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_stages(dataset: dict, repeat=3) -> dict:
+    """
+    Times the processing stages on a data set. Must run in a process that imports the data set's config
+    :param dataset: The paths returned by synthetic_data.generate_dataset
+    :return: {stage: {"seconds": ..., "files_per_s": ...}}, or {stage: {"skipped": reason}}.
+    "startup" is the time of a new interpreter importing STARTUP_MODULES
+    """
+    from gamma_spectrum import SpectrumProcessor, load_spectrum
+    from peak_fitting import fit_peaks
+
+    processor = SpectrumProcessor()
+    processor.disable_result_cache()
+    spectra = [load_spectrum(path) for path in dataset["spe"]]
+    n_files = len(spectra)
+    times = (np.arange(n_files) + 0.5) * (synthetic_data.LIVE_TIME + synthetic_data.DEAD_TIME)
+
+    def get_counts_stack():
+        return np.stack([sp.counts for sp in spectra]),
+
+    def fit_decay_stage(counts):
+        from fit_decay import fit_decay
+        fit = fit_peaks(counts, *PEAK_WINDOW)
+        fit_decay(times[fit.success], fit.areas[fit.success], sigma=fit.area_errors[fit.success])
+
+    stages = {}
+    for data_format in FORMATS:
+        if data_format in dataset:
+            stages[f"load_{data_format}"] = (lambda paths: [load_spectrum(path) for path in paths],
+                                             lambda paths=dataset[data_format]: (paths,))
+    stages.update({
+        "sum_spectra": (lambda: processor.sum_spectra(spectra, name_modifier="Shot_1"), None),
+        "subtract_background": (lambda: list(processor.subtract_background_multiple(spectra, significance=3)),
+                                None),
+        "apply_filtering": (processor.filter_multiple, lambda: ([sp.copy() for sp in spectra],)),
+        "fit_peaks": (lambda counts: fit_peaks(counts, *PEAK_WINDOW), get_counts_stack),
+        "fit_decay": (fit_decay_stage, get_counts_stack),
+    })
+
+    results = {}
+    for name, (function, setup) in stages.items():
+        try:
+            # The stages report to the console, which is not part of the benchmark
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                seconds = time_stage(function, setup, repeat)
+        except ImportError as e:
+            results[name] = {"skipped": str(e)}
+            continue
+        results[name] = {"seconds": seconds, "files_per_s": n_files / seconds}
+
+    command = (f"import sys; sys.path[:0] = {[os.path.dirname(dataset['config']), REPO_DIRECTORY]!r}; "
+               f"import {', '.join(STARTUP_MODULES)}")
+    results["startup"] = {"seconds": time_stage(lambda: subprocess.run([sys.executable, "-c", command], check=True),
+                                                repeat=repeat)}
+    return results
+
+
+def run_child() -> None:
+    """
+    Entry point of the benchmark process, see CHILD_COMMAND. Arguments: data set, repository, data set paths .json,
+    number of repeats, results .json
+    """
+    dataset_paths, repeat, results_path = sys.argv[3], int(sys.argv[4]), sys.argv[5]
+    with open(dataset_paths) as f:
+        dataset = json.load(f)
+    results = run_stages(dataset, repeat)
+    with open(results_path, "w") as f:
+        json.dump(results, f)
+
+
+def get_dataset(data_directory: str, n_files: int, formats=FORMATS) -> dict:
+    """
+    Generates a data set of n_files, or reuses an earlier one in data_directory
+    """
+    directory = os.path.join(data_directory, f"{n_files}_files")
+    paths_file = os.path.join(directory, "dataset.json")
+    if os.path.isfile(paths_file):
+        with open(paths_file) as f:
+            dataset = json.load(f)
+        if all(len(dataset.get(data_format, ())) == n_files and all(map(os.path.isfile, dataset[data_format]))
+               for data_format in formats):
+            return dataset
+    print(f"Generating {n_files} files in {directory}")
+    dataset = synthetic_data.generate_dataset(directory, n_files, formats=formats)
+    with open(paths_file, "w") as f:
+        json.dump(dataset, f)
+    return dataset
+
+
+def run_suite(scales=SCALES, repeat=3, data_directory=None) -> dict:
+    """
+    Times every stage at every scale, each scale in a separate process
+    :param scales: Numbers of files
+    :param data_directory: Directory to keep the generated data sets in (default: a temporary directory)
+    :return: {"metadata": {...}, "results": {scale: {stage: {...}}}}
+    """
+    with contextlib.ExitStack() as stack:
+        if data_directory is None:
+            data_directory = stack.enter_context(tempfile.TemporaryDirectory())
+        results = {}
+        for n_files in scales:
+            dataset = get_dataset(data_directory, n_files)
+            directory = os.path.dirname(dataset["config"])
+            results_path = os.path.join(directory, "results.json")
+            print(f"Benchmarking {n_files} files")
+            subprocess.run([sys.executable, "-c", CHILD_COMMAND, directory, REPO_DIRECTORY,
+                            os.path.join(directory, "dataset.json"), str(repeat), results_path],
+                           cwd=directory, check=True)
+            with open(results_path) as f:
+                results[str(n_files)] = json.load(f)
+
+    metadata = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "platform": platform.platform(),
+                "python": platform.python_version(), "numpy": np.__version__, "cpu_count": os.cpu_count(),
+                "repeat": repeat}
+    return {"metadata": metadata, "results": results}
+
+
+def compare_results(results: dict, baseline: dict, tolerance=0.25, min_seconds=0.005) -> list[tuple]:
+    """
+    :param tolerance: Allowed relative slowdown
+    :param min_seconds: Slowdowns smaller than this are timing noise and never regressions
+    :return: (scale, stage, baseline seconds, seconds, ratio, is_regression) of the stages timed in both
+    """
+    comparison = []
+    for scale, stages in results["results"].items():
+        for stage, result in stages.items():
+            reference = baseline["results"].get(scale, {}).get(stage, {})
+            if "seconds" not in result or "seconds" not in reference:
+                continue
+            ratio = result["seconds"] / reference["seconds"]
+            is_regression = ratio > 1 + tolerance and result["seconds"] - reference["seconds"] > min_seconds
+            comparison.append((scale, stage, reference["seconds"], result["seconds"], ratio, is_regression))
+    return comparison
+
+
+def print_results(results: dict) -> None:
+    print(f"{'files':>6}  {'stage':<22}{'time, s':>10}{'files/s':>12}")
+    print("-" * 50)
+    for scale, stages in results["results"].items():
+        for stage, result in stages.items():
+            if "files_per_s" in result:
+                print(f"{scale:>6}  {stage:<22}{result['seconds']:>10.3f}{result['files_per_s']:>12.1f}")
+            elif "seconds" in result:
+                print(f"{scale:>6}  {stage:<22}{result['seconds']:>10.3f}")
+            else:
+                print(f"{scale:>6}  {stage:<22}  skipped: {result['skipped']}")
+
+
+def print_comparison(comparison: list[tuple]) -> None:
+    print(f"{'files':>6}  {'stage':<22}{'baseline':>10}{'current':>10}{'ratio':>8}")
+    print("-" * 56)
+    for scale, stage, reference, seconds, ratio, is_regression in comparison:
+        print(f"{scale:>6}  {stage:<22}{reference:>10.3f}{seconds:>10.3f}{ratio:>7.2f}x"
+              + ("  REGRESSION" if is_regression else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", nargs="+", type=int, default=list(SCALES), help="Numbers of files per data set")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repeats per stage")
+    parser.add_argument("--data", type=str, default=None, help="Directory to keep the generated data sets in")
+    parser.add_argument("--output", type=str, default=None, help="Path of the results .json file")
+    parser.add_argument("--baseline", type=str, default=None, help="Results .json file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown relative to the baseline")
+    args = parser.parse_args()
+
+    suite_results = run_suite(args.scales, repeat=args.repeat, data_directory=args.data)
+    print()
+    print_results(suite_results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(suite_results, f, indent=4)
+        print(f"\nResults saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_results = json.load(f)
+        stage_comparison = compare_results(suite_results, baseline_results, tolerance=args.tolerance)
+        print()
+        print_comparison(stage_comparison)
+        regressions = [row for row in stage_comparison if row[-1]]
+        if regressions:
+            print(f"\n{len(regressions)} regressions above {args.tolerance:.0%}")
+            sys.exit(1)
+        print("\nNo regressions")
@@ -0,0 +1,81 @@
+import argparse
+import os
+import time
+import config
+import spe_reader
+from misc import get_filenames
+
+"""
+Usage:
+python benchmarks.py "input_path" --repeat 3
+"input_path": A directory with .Spe files to benchmark the loaders on
+--repeat: How many times each benchmark is repeated (the best time is reported)
+"""
+
+
+def legacy_load_spe(path: str) -> (list, list, list, list):
+    """
+    The line-based .Spe parser used by GammaSpectrum.load before the vectorized spe_reader
+    """
+    with open(path) as f:
+        lines = f.read().splitlines()
+    header_end_index = next((i for i, line in enumerate(lines) if
+                             config.spectra_files["header_end"] in line)) + 2
+    footer_start_index = next((i for i, line in enumerate(lines[::-1]) if
+                               config.spectra_files["footer_start"] in line)) + 1
+    header = lines[:header_end_index]
+    footer = lines[-footer_start_index:]
+    times = list(map(int, lines[config.spectra_files["time_line"]].split()))
+    counts = [int(line) for line in lines[header_end_index:-footer_start_index]]
+    return header, footer, times, counts
+
+
+def time_function(function, args: list, repeat=3) -> float:
+    """
+    Calls the function for every argument and returns the best total time of all repeats in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for arg in args:
+            function(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_spe_reader(files: list[str], repeat=3) -> dict:
+    """
+    Compares the throughput of the vectorized spe_reader against the legacy line-based loader
+    :param files: .Spe files to load
+    :param repeat: Number of repeats, the best time is used
+    :return: {loader_name: {"seconds": ..., "files_per_s": ..., "mb_per_s": ...}}
+    """
+    total_mb = sum(os.path.getsize(f) for f in files) / 1e6
+    results = {}
+    for name, loader in (("legacy", legacy_load_spe), ("spe_reader", spe_reader.read_spe)):
+        seconds = time_function(loader, files, repeat)
+        results[name] = {"seconds": seconds,
+                         "files_per_s": len(files) / seconds,
+                         "mb_per_s": total_mb / seconds}
+    return results
+
+
+def print_results(results: dict, reference="legacy") -> None:
+    print(f"{'loader':<12}{'time, s':>10}{'files/s':>12}{'MB/s':>10}{'speedup':>10}")
+    print("-" * 54)
+    for name, r in results.items():
+        speedup = results[reference]["seconds"] / r["seconds"]
+        print(f"{name:<12}{r['seconds']:>10.3f}{r['files_per_s']:>12.1f}{r['mb_per_s']:>10.1f}{speedup:>9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", type=str, help="Path to the folder with .Spe files")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repeats per benchmark")
+    args = parser.parse_args()
+
+    spe_files = get_filenames(args.input_path, ".Spe")
+    if not spe_files:
+        raise ValueError(f"No .Spe files found in {args.input_path}")
+    print(f"Loading {len(spe_files)} files from {args.input_path}\n")
+    print_results(bench_spe_reader(spe_files, repeat=args.repeat))
@@ -1,16 +1,50 @@
+import threading
 from config import DetectorType
 import config
+from energy_calibration import EnergyCalibration, DEFAULT_CHANNELS
 
 
 class Detector:
+    """
+    Detector properties from the config.
+    There is one shared, immutable Detector instance per DetectorType: Detector(detector_type) returns it,
+    creating it and precomputing its energy scale on the first call.
+    The energy calibration is read from config.detectors[type]["energy_calibration"],
+    either as {"intercept": c0, "slope": c1} or as polynomial {"coefficients": [c0, c1, c2, ...]}
+    """
+    CHANNELS = DEFAULT_CHANNELS
 
-    def __init__(self, detector_type: DetectorType):
-        self.CHANNELS = 8191
-        self.type = detector_type
-        self.name = self.type.value
-        self.bg_path = config.detectors[self.type]["bg_path"]
-        self.bg_times = config.detectors[self.type]["bg_times"]
-        self.intercept = config.detectors[self.type]["energy_calibration"]["intercept"]
-        self.slope = config.detectors[self.type]["energy_calibration"]["slope"]
-        self.energy_scale = [self.intercept + self.slope * channel for channel in range(self.CHANNELS)]
+    __slots__ = ("type", "name", "bg_path", "bg_times", "calibration", "energy_scale")
 
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __new__(cls, detector_type: DetectorType):
+        instance = cls._instances.get(detector_type)
+        if instance is None:
+            with cls._lock:
+                instance = cls._instances.get(detector_type)
+                if instance is None:
+                    instance = super().__new__(cls)
+                    instance._init(detector_type)
+                    cls._instances[detector_type] = instance
+        return instance
+
+    def _init(self, detector_type: DetectorType) -> None:
+        def set_attr(name, value):
+            object.__setattr__(self, name, value)
+
+        set_attr("type", detector_type)
+        set_attr("name", detector_type.value)
+        set_attr("bg_path", config.detectors[detector_type]["bg_path"])
+        set_attr("bg_times", tuple(config.detectors[detector_type]["bg_times"]))
+        calibration = EnergyCalibration.from_config(config.detectors[detector_type]["energy_calibration"],
+                                                    self.CHANNELS)
+        set_attr("calibration", calibration)
+        set_attr("energy_scale", calibration.energy_grid)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Detector instances are shared and can not be modified")
+
+    def __reduce__(self):
+        return Detector, (self.type,)
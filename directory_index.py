@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import re
+import tempfile
+import config
+import misc
+import spe_reader
+from config import DetectorType
+
+"""
+Persistent index of the spectrum files in a directory.
+The index maps every supported file to its shot, detector, file number, size, mtime and, for .Spe files,
+the live/real times and number of channels read from the header. It is saved as MANIFEST_NAME in the directory
+and refreshed incrementally: only files that are new or whose size or mtime changed are read again,
+and the directory is not even listed while its own mtime is unchanged (files are added, not edited in place).
+Range and detector queries are answered from the index without opening the files.
+
+Usage:
+python directory_index.py "input_path" --start 10 --end 20 --detector BigDet
+"input_path": The directory to index
+--start, --end: Print only the files numbered start to end (both inclusive)
+--detector: Print only the files of this detector (e.g. BigDet)
+"""
+
+MANIFEST_NAME = ".gamma_index"
+MANIFEST_VERSION = 1
+
+
+class IndexEntry:
+    """
+    The indexed properties of one spectrum file
+    """
+    __slots__ = ("name", "shot", "detector", "file_number", "size", "mtime_ns", "times", "channels")
+
+    def __init__(self, name: str, shot=None, detector=None, file_number=None, size=0, mtime_ns=0, times=None,
+                 channels=None):
+        self.name = name
+        self.shot = shot
+        self.detector = detector
+        self.file_number = file_number
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.times = times
+        self.channels = channels
+
+    def to_dict(self) -> dict:
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+    @staticmethod
+    def from_dict(values: dict) -> "IndexEntry":
+        return IndexEntry(**values)
+
+
+def describe_file(directory: str, name: str, stat: os.stat_result) -> IndexEntry:
+    """
+    Builds the index entry of a file. Only the header of .Spe files is read
+    """
+    stem = os.path.splitext(name)[0]
+    shot = re.search(r"Shot_\d+", name) or re.search(r"Shot_\d+", directory)
+    path = os.path.join(directory, name)
+    detector = next((dtype.value for dtype in DetectorType if dtype.value in path), None)
+    number = re.search(r"(\d{3,})$", stem)
+    entry = IndexEntry(name, shot=shot.group() if shot else None, detector=detector,
+                       file_number=int(number.group()) if number else None, size=stat.st_size,
+                       mtime_ns=stat.st_mtime_ns)
+    if misc.check_file_extension(name, ".Spe"):
+        try:
+            spe = spe_reader.read_spe_header(path)
+            first_channel, last_channel = spe_reader.parse_channel_range(spe.header, spe.data_start)
+        except (ValueError, IndexError, OSError):
+            return entry
+        entry.times = spe.times.tolist()
+        entry.channels = last_channel - first_channel + 1
+    return entry
+
+
+class DirectoryIndex:
+    """
+    The index of one directory, see the module docstring
+    """
+
+    def __init__(self, directory: str, extensions=None):
+        """
+        :param directory: The indexed directory
+        :param extensions: Indexed file extensions (default: config.SUPPORTED_FILE_EXTENSIONS)
+        """
+        self.directory = directory
+        self.extensions = tuple(extensions or config.SUPPORTED_FILE_EXTENSIONS)
+        self.entries = {}
+        self.directory_mtime_ns = None
+        self._load_manifest()
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    def _load_manifest(self) -> None:
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get("version") != MANIFEST_VERSION:
+            return
+        self.entries = {name: IndexEntry.from_dict(values) for name, values in manifest["entries"].items()}
+        self.directory_mtime_ns = manifest.get("directory_mtime_ns")
+
+    def _save_manifest(self, in_place=False) -> None:
+        """
+        :param in_place: Overwrite the existing manifest instead of replacing it. Unlike replacing it,
+        this does not change the directory mtime, but a run stopped while writing leaves a manifest that is not read
+        """
+        manifest = {"version": MANIFEST_VERSION, "directory_mtime_ns": self.directory_mtime_ns,
+                    "entries": {name: entry.to_dict() for name, entry in self.entries.items()}}
+        try:
+            if in_place and os.path.isfile(self.manifest_path):
+                with open(self.manifest_path, "r+") as f:
+                    json.dump(manifest, f)
+                    f.truncate()
+                return
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=MANIFEST_NAME)
+            with os.fdopen(fd, "w") as f:
+                json.dump(manifest, f)
+            os.replace(temp_path, self.manifest_path)
+        except OSError:
+            # Read-only directory: the index is kept in memory only
+            pass
+
+    def refresh(self, check_files=False) -> "DirectoryIndex":
+        """
+        Re-reads new and changed files, drops deleted ones and saves the manifest if anything changed
+        :param check_files: Compare every file's size and mtime even if the directory mtime is unchanged,
+        to detect files edited in place
+        """
+        # Taken before listing: files added during the scan change the mtime again and are found on the next refresh
+        directory_mtime_ns = os.stat(self.directory).st_mtime_ns
+        if not check_files and directory_mtime_ns == self.directory_mtime_ns:
+            return self
+
+        changed = False
+        found = set()
+        with os.scandir(self.directory) as scan:
+            for dir_entry in scan:
+                if not misc.check_file_extension(dir_entry.name, *self.extensions) or not dir_entry.is_file():
+                    continue
+                found.add(dir_entry.name)
+                stat = dir_entry.stat()
+                entry = self.entries.get(dir_entry.name)
+                if entry is None or entry.size != stat.st_size or entry.mtime_ns != stat.st_mtime_ns:
+                    self.entries[dir_entry.name] = describe_file(self.directory, dir_entry.name, stat)
+                    changed = True
+
+        for name in set(self.entries) - found:
+            del self.entries[name]
+            changed = True
+        if changed:
+            # Replacing the manifest changes the directory mtime: the next refresh scans once more
+            # and stores the new mtime in place
+            self.directory_mtime_ns = directory_mtime_ns
+            self._save_manifest()
+        elif directory_mtime_ns != self.directory_mtime_ns:
+            self.directory_mtime_ns = directory_mtime_ns
+            self._save_manifest(in_place=True)
+        return self
+
+    def select(self, start=None, end=None, detector=None, extensions=None) -> list[IndexEntry]:
+        """
+        Indexed files, sorted by their file number
+        :param start: First file number (inclusive)
+        :param end: Last file number (inclusive)
+        :param detector: DetectorType (or its name) of the files
+        :param extensions: File extensions to select
+        :return: The matching entries
+        """
+        if isinstance(detector, DetectorType):
+            detector = detector.value
+        selected = []
+        for entry in self.entries.values():
+            if extensions and not misc.check_file_extension(entry.name, *extensions):
+                continue
+            if detector is not None and entry.detector != detector:
+                continue
+            if start is not None and (entry.file_number is None or entry.file_number < start):
+                continue
+            if end is not None and (entry.file_number is None or entry.file_number > end):
+                continue
+            selected.append(entry)
+        return sorted(selected, key=lambda entry: misc.get_file_sort_key(entry.name))
+
+    def paths(self, start=None, end=None, detector=None, extensions=None) -> list[str]:
+        """
+        Paths of the files selected as in select
+        """
+        return [os.path.join(self.directory, entry.name) for entry in self.select(start, end, detector, extensions)]
+
+
+_indexes = {}
+
+
+def get_index(directory: str) -> DirectoryIndex:
+    """
+    Returns the refreshed index of a directory. Indexes are kept for the rest of the run
+    """
+    key = os.path.abspath(directory)
+    index = _indexes.get(key)
+    if index is None:
+        index = _indexes[key] = DirectoryIndex(directory)
+    return index.refresh()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", type=str, help="The directory to index")
+    parser.add_argument("--start", type=int, help="First file number")
+    parser.add_argument("--end", type=int, help="Last file number")
+    parser.add_argument("--detector", type=str, help="Detector name, e.g. BigDet")
+    args = parser.parse_args()
+
+    for indexed in get_index(args.input_path).select(args.start, args.end, args.detector):
+        print(f"{indexed.name}: shot {indexed.shot}, detector {indexed.detector}, number {indexed.file_number}, "
+              f"times {indexed.times}, channels {indexed.channels}")
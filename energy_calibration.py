@@ -1,6 +1,117 @@
+import numpy as np
+from numpy.polynomial import polynomial
+
+"""
+Channel <-> energy calibration of a detector.
+The calibration is a polynomial E(channel) = c0 + c1 * channel + c2 * channel^2 + ...
+The energies of all channels (the energy grid) are computed once. Energy -> channel conversions are a binary search
+on that grid, so they cost the same for any polynomial degree and need no root finding.
+"""
+
+DEFAULT_CHANNELS = 8191
+
+
 class EnergyCalibration:
-    def __init__(self, coefficients):
-        ...
+    """
+    A monotonically increasing polynomial energy calibration with its precomputed energy grid
+    """
+    __slots__ = ("coefficients", "energy_grid")
+
+    def __init__(self, coefficients, channels=DEFAULT_CHANNELS):
+        """
+        :param coefficients: Polynomial coefficients in increasing order [c0, c1, ...], energies in keV
+        :param channels: Number of channels of the energy grid
+        """
+        self.coefficients = tuple(float(c) for c in coefficients)
+        if len(self.coefficients) < 2:
+            raise ValueError("An energy calibration needs at least an intercept and a slope")
+
+        energy_grid = self.calibrate(np.arange(channels, dtype=np.float64))
+        if np.any(np.diff(energy_grid) <= 0):
+            raise ValueError(f"Energy calibration {self.coefficients} is not increasing over {channels} channels")
+        energy_grid.setflags(write=False)
+        self.energy_grid = energy_grid
+
+    @staticmethod
+    def from_config(calibration: dict, channels=DEFAULT_CHANNELS) -> "EnergyCalibration":
+        """
+        :param calibration: {"coefficients": [c0, c1, ...]} or {"intercept": c0, "slope": c1}
+        :param channels: Number of channels of the energy grid
+        """
+        if "coefficients" in calibration:
+            return EnergyCalibration(calibration["coefficients"], channels)
+        return EnergyCalibration([calibration["intercept"], calibration["slope"]], channels)
+
+    @staticmethod
+    def fit(channels, energies, degree=1, weights=None, n_channels=DEFAULT_CHANNELS) -> "EnergyCalibration":
+        """
+        Fits a calibration to known lines
+        :param channels: Peak positions (channels, may be fractional)
+        :param energies: The known energies of the lines in keV
+        :param degree: Degree of the polynomial
+        :param weights: Weights of the lines, e.g. 1 / peak position uncertainty
+        :param n_channels: Number of channels of the energy grid
+        :return: The fitted calibration
+        """
+        channels = np.asarray(channels, dtype=np.float64)
+        if len(channels) <= degree:
+            raise ValueError(f"At least {degree + 1} lines are needed for a degree {degree} calibration")
+        coefficients = polynomial.polyfit(channels, np.asarray(energies, dtype=np.float64), degree, w=weights)
+        return EnergyCalibration(coefficients, n_channels)
+
+    def __len__(self):
+        return len(self.energy_grid)
+
+    def __eq__(self, other):
+        if not isinstance(other, EnergyCalibration):
+            return NotImplemented
+        return self.coefficients == other.coefficients and len(self) == len(other)
+
+    def __hash__(self):
+        return hash((self.coefficients, len(self)))
+
+    def __repr__(self):
+        return f"EnergyCalibration({list(self.coefficients)}, {len(self)})"
+
+    def calibrate(self, channels) -> np.ndarray:
+        """
+        Energies (keV) of channels, which may be fractional
+        """
+        return polynomial.polyval(np.asarray(channels, dtype=np.float64), self.coefficients)
+
+    def get_energies(self, length: int) -> np.ndarray:
+        """
+        Energies of the first length channels, a read-only view of the energy grid where possible
+        """
+        if length <= len(self.energy_grid):
+            return self.energy_grid[:length]
+        return self.calibrate(np.arange(length))
+
+    def energy_to_channel(self, energies) -> np.ndarray:
+        """
+        Nearest channels of energies (keV), clipped to the energy grid
+        """
+        energies = np.asarray(energies, dtype=np.float64)
+        grid = self.energy_grid
+        upper = np.clip(np.searchsorted(grid, energies), 1, len(grid) - 1)
+        lower = upper - 1
+        return np.where(energies - grid[lower] <= grid[upper] - energies, lower, upper).astype(np.int64)
+
+    def energy_to_fractional_channel(self, energies) -> np.ndarray:
+        """
+        Channels of energies (keV), linearly interpolated between the grid points
+        """
+        return np.interp(energies, self.energy_grid, np.arange(len(self.energy_grid), dtype=np.float64))
+
+    def channel_range(self, energy_start: float, energy_end: float) -> slice:
+        """
+        The channels whose energies lie between energy_start and energy_end (both inclusive), e.g. for plot limits
+        """
+        return slice(int(np.searchsorted(self.energy_grid, energy_start, side="left")),
+                     int(np.searchsorted(self.energy_grid, energy_end, side="right")))
 
-    def calibrate(self, channel):
-        ...
+    def residuals(self, channels, energies) -> np.ndarray:
+        """
+        Known minus calibrated energies of lines, to check a fit
+        """
+        return np.asarray(energies, dtype=np.float64) - self.calibrate(channels)
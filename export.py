@@ -0,0 +1,284 @@
+import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import spe_reader
+import instrumentation
+from instrumentation import profiled
+
+"""
+Output formats of GammaSpectrum and batch export.
+The render_* functions produce the exact bytes of the .Spe, .csv and .json outputs,
+BatchWriter renders and writes many spectra on a pool of writer threads.
+"""
+
+NPZ_EXTENSION = ".npz"
+# "format" of sparse .json and .npz outputs, see sparse_spectrum.py
+SPARSE_FORMAT = "sparse"
+# Added to the file names of sparse outputs, which would otherwise replace the dense .json and .npz outputs
+SPARSE_SUFFIX = "_sparse"
+
+
+@profiled
+def render_spe(spectrum) -> bytes:
+    return spectrum.header + spe_reader.format_counts(spectrum.counts, spe_reader.get_newline(spectrum.header)) + \
+        spectrum.footer
+
+
+def _count_list(spectrum) -> list:
+    """
+    The counts as a list. The channels dropped by background subtraction (see GammaSpectrum.zeros_dropped)
+    are written as 0 instead of 0.0, as in older versions
+    """
+    values = spectrum.counts.tolist()
+    if spectrum.zeros_dropped and spectrum.counts.dtype.kind == "f":
+        for i in np.flatnonzero(spectrum.counts == 0).tolist():
+            values[i] = 0
+    return values
+
+
+@profiled
+def render_csv(spectrum, output_energies=False) -> str:
+    """
+    Two-column "channel,count" (or "energy,count") table, identical to the output of csv.writer
+    """
+    data = spectrum.energies if output_energies else spectrum.channels
+    if not len(data):
+        return ""
+    return "\r\n".join(map(",".join, zip(map(repr, data.tolist()), map(repr, _count_list(spectrum))))) + "\r\n"
+
+
+def _indented_list(values: list, indent: int) -> str:
+    """
+    A list of numbers formatted like json.dumps(..., indent=4) at the given indentation level,
+    but encoded by the fast compact encoder
+    """
+    if not values:
+        return "[]"
+    item_separator = ",\n" + " " * 4 * (indent + 1)
+    return ("[\n" + " " * 4 * (indent + 1) + json.dumps(values)[1:-1].replace(", ", item_separator) + "\n" +
+            " " * 4 * indent + "]")
+
+
+@profiled
+def render_json(spectrum, compact=False) -> str:
+    """
+    :param compact: Write without indentation or spaces, smaller and faster to parse.
+    compact=False gives the indented format of older versions, byte for byte
+    """
+    arrays = {
+        "spectrum_recording_times": spectrum.times.tolist() if spectrum.times is not None else None,
+        "counts": spectrum.counts.tolist() if compact else _count_list(spectrum),
+        "channels": spectrum.channels.tolist(),
+        "energies": spectrum.energies.tolist() if spectrum.energies is not None else None,
+    }
+    if compact:
+        json_data = {
+            "metadata": {"spectrum_name": spectrum.name, "detector": spectrum.detector.name,
+                         "spectrum_recording_times": arrays["spectrum_recording_times"]},
+            "data": {key: arrays[key] for key in ("counts", "channels", "energies")}
+        }
+        return json.dumps(json_data, separators=(",", ":"))
+
+    # The indented encoder is slow for long lists: the lists are replaced by placeholders
+    # and inserted afterwards with the same formatting
+    placeholders = {key: f"@@{key}@@" if value is not None else None for key, value in arrays.items()}
+    json_data = {
+        "metadata": {"spectrum_name": spectrum.name, "detector": spectrum.detector.name,
+                     "spectrum_recording_times": placeholders["spectrum_recording_times"]},
+        "data": {key: placeholders[key] for key in ("counts", "channels", "energies")}
+    }
+    skeleton = json.dumps(json_data, indent=4)
+    for key, placeholder in placeholders.items():
+        if placeholder is not None:
+            # The last occurrence is the placeholder: the spectrum name, which could look the same, comes first
+            before, _, after = skeleton.rpartition(f'"{placeholder}"')
+            skeleton = before + _indented_list(arrays[key], 2) + after
+    return skeleton
+
+
+@profiled
+def write_npz(spectrum, out_path: str) -> None:
+    """
+    Binary output: the arrays of the spectrum in an uncompressed .npz archive, read back by GammaSpectrum.load
+    """
+    arrays = {"name": np.array(spectrum.name), "detector": np.array(spectrum.detector.name),
+              "counts": spectrum.counts, "channels": spectrum.channels}
+    for name in ("times", "energies"):
+        if getattr(spectrum, name) is not None:
+            arrays[name] = getattr(spectrum, name)
+    with open(out_path, "wb") as f:
+        np.savez(f, **arrays)
+        instrumentation.add_bytes_written(f.tell())
+
+
+@profiled
+def render_sparse_json(sparse_spectrum) -> str:
+    """
+    Compact JSON of a SparseSpectrum (see sparse_spectrum.py): only the indices and counts of the nonzero channels
+    """
+    json_data = {
+        "metadata": {"spectrum_name": sparse_spectrum.name, "detector": sparse_spectrum.detector.name,
+                     "spectrum_recording_times": sparse_spectrum.times.tolist()
+                     if sparse_spectrum.times is not None else None,
+                     "format": SPARSE_FORMAT},
+        "data": {"length": sparse_spectrum.length, "indices": sparse_spectrum.indices.tolist(),
+                 "counts": sparse_spectrum.values.tolist()}
+    }
+    return json.dumps(json_data, separators=(",", ":"))
+
+
+@profiled
+def write_sparse_npz(sparse_spectrum, out_path: str) -> None:
+    """
+    Binary output of a SparseSpectrum: its indices and values in an uncompressed .npz archive
+    """
+    arrays = {"name": np.array(sparse_spectrum.name), "detector": np.array(sparse_spectrum.detector.name),
+              "format": np.array(SPARSE_FORMAT), "length": np.array(sparse_spectrum.length),
+              "indices": sparse_spectrum.indices, "values": sparse_spectrum.values}
+    if sparse_spectrum.times is not None:
+        arrays["times"] = sparse_spectrum.times
+    with open(out_path, "wb") as f:
+        np.savez(f, **arrays)
+        instrumentation.add_bytes_written(f.tell())
+
+
+@profiled
+def write_output(spectrum, out_path: str, render, operation: str, params=None, binary=False, newline=None,
+                 cache=None) -> bool:
+    """
+    Writes a rendered output file. With a result cache, the SHA-256 of the written file is cached:
+    if the existing file still has it, the output is neither rendered nor rewritten
+    :param render: Returns the file contents (bytes if binary, else str)
+    :param operation: Name of the output format, part of the cache key
+    :param params: Rendering parameters, part of the cache key
+    :param cache: A ResultCache or None
+    :return: False if the file was already up to date
+    """
+    key = None
+    if cache is not None:
+        key = cache.make_key(operation, cache.spectrum_hash(spectrum), params)
+        written_hash = cache.get(key)
+        if written_hash is not None and os.path.isfile(out_path) and cache.file_hash(out_path) == written_hash:
+            return False
+
+    contents = render()
+    with open(out_path, "wb" if binary else "w", newline=newline) as f:
+        f.write(contents)
+    instrumentation.add_bytes_written(len(contents))
+    if cache is not None:
+        cache.put(key, cache.file_hash(out_path))
+    return True
+
+
+class BatchWriter:
+    """
+    Saves many spectra on a pool of writer threads, in the background of the processing.
+    Spectra are snapshotted (shallow copied) when queued, so they can be processed further right away.
+    Output directories are created once, and one summary line per directory is printed on close
+
+        with BatchWriter() as writer:
+            for spectrum in spectra:
+                writer.save_json(spectrum, out_directory)
+    """
+
+    def __init__(self, workers=4, compact_json=False, max_in_flight=None, cache=None):
+        """
+        :param workers: Number of writer threads
+        :param compact_json: Write compact JSON instead of the indented format of older versions
+        :param max_in_flight: Maximum number of queued outputs (default: 4 * workers), bounds the memory
+        of rendered outputs waiting to be written
+        :param cache: A ResultCache used as in write_output
+        """
+        self.compact_json = compact_json
+        self.max_in_flight = max_in_flight or 4 * workers
+        self.cache = cache
+        self.written = []
+        self.unchanged = []
+        self._directories = set()
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(report=exc_type is None)
+
+    def _prepare_directory(self, directory: str) -> None:
+        if directory not in self._directories:
+            os.makedirs(directory, exist_ok=True)
+            self._directories.add(directory)
+
+    def _submit(self, out_path: str, function, *args) -> None:
+        self._prepare_directory(os.path.dirname(out_path) or ".")
+        while len(self._pending) >= self.max_in_flight:
+            self._pending.popleft().result()
+        self._pending.append(self._executor.submit(self._run, out_path, function, *args))
+
+    def _run(self, out_path: str, function, *args) -> None:
+        written = function(*args)
+        with self._lock:
+            (self.written if written is not False else self.unchanged).append(out_path)
+
+    def save_spe(self, spectrum, out_path: str) -> None:
+        spectrum = spectrum.copy()
+        self._submit(out_path, write_output, spectrum, out_path, lambda: render_spe(spectrum), "save_spe", None, True,
+                     None, self.cache)
+
+    def save_raw(self, spectrum, out_directory: str, output_energies=False, filename_suffix="") -> None:
+        spectrum = spectrum.copy()
+        out_path = os.path.join(out_directory, f"{spectrum.name}{filename_suffix}.csv")
+        self._submit(out_path, write_output, spectrum, out_path, lambda: render_csv(spectrum, output_energies),
+                     "save_raw", {"output_energies": output_energies}, False, "", self.cache)
+
+    def save_json(self, spectrum, out_directory: str, filename_suffix="") -> None:
+        spectrum = spectrum.copy()
+        compact = self.compact_json
+        out_path = os.path.join(out_directory, f"{spectrum.name}{filename_suffix}.json")
+        self._submit(out_path, write_output, spectrum, out_path, lambda: render_json(spectrum, compact),
+                     "save_json", {"compact": compact}, False, None, self.cache)
+
+    def save_npz(self, spectrum, out_directory: str, filename_suffix="") -> None:
+        out_path = os.path.join(out_directory, f"{spectrum.name}{filename_suffix}{NPZ_EXTENSION}")
+        self._submit(out_path, write_npz, spectrum.copy(), out_path)
+
+    def save_sparse(self, sparse_spectrum, out_directory: str, binary=False, filename_suffix="") -> None:
+        """
+        Saves a SparseSpectrum (see sparse_spectrum.py) as sparse .json, or as .npz if binary.
+        The file name ends with SPARSE_SUFFIX
+        """
+        out_path = os.path.join(out_directory, f"{sparse_spectrum.name}{filename_suffix}{SPARSE_SUFFIX}"
+                                               f"{NPZ_EXTENSION if binary else '.json'}")
+        if binary:
+            self._submit(out_path, write_sparse_npz, sparse_spectrum, out_path)
+        else:
+            self._submit(out_path, write_output, sparse_spectrum, out_path,
+                         lambda: render_sparse_json(sparse_spectrum), "save_sparse_json")
+
+    def wait(self) -> None:
+        """
+        Waits until all queued outputs are written, raising the first error
+        """
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close(self, report=True) -> None:
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+        if report:
+            self.print_summary()
+
+    def print_summary(self) -> None:
+        counts = {}
+        for paths, column in ((self.written, 0), (self.unchanged, 1)):
+            for path in paths:
+                directory_counts = counts.setdefault(os.path.dirname(path), [0, 0])
+                directory_counts[column] += 1
+        for directory, (saved, unchanged) in counts.items():
+            print(f"{saved} files saved in {directory}" + (f" ({unchanged} up to date)" if unchanged else ""))
@@ -0,0 +1,94 @@
+import numpy as np
+from instrumentation import profiled
+
+"""
+Filter bank for spectrum stacks.
+Every filter takes a single spectrum or an (n_spectra x channels) stack and works along the channel axis,
+so a whole shot is smoothed or has its continuum removed in one array operation. Nothing is printed,
+noise estimates are returned as arrays.
+scipy is imported by the filters that use it on their first call, as it takes longer to import
+than the rest of the program.
+"""
+
+
+def estimate_noise(counts: np.ndarray) -> np.ndarray:
+    """
+    Robust noise level of each spectrum: the median absolute difference of neighbouring channels / 0.6745
+    :param counts: A spectrum or an (n_spectra x channels) stack
+    :return: (n_spectra,) noise levels
+    """
+    # float differences, unsigned counts would wrap around
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.float64))
+    return np.median(np.abs(np.diff(counts, axis=1)), axis=1) / 0.6745
+
+
+def gaussian(counts: np.ndarray, sigma=1.0) -> np.ndarray:
+    """
+    Gaussian smoothing. The result has the dtype of the input, like scipy's gaussian_filter1d
+    :param sigma: Standard deviation of the Gaussian kernel in channels
+    """
+    from scipy.ndimage import gaussian_filter1d
+    return gaussian_filter1d(counts, sigma=sigma, axis=-1)
+
+
+def savitzky_golay(counts: np.ndarray, window_length=7, polyorder=2) -> np.ndarray:
+    """
+    Savitzky-Golay smoothing, preserves peak heights and widths better than the Gaussian filter
+    :param window_length: Odd number of channels in the fitting window
+    :param polyorder: Order of the polynomial fitted in each window
+    """
+    from scipy.signal import savgol_filter
+    return savgol_filter(np.asarray(counts, dtype=np.float64), window_length, polyorder, axis=-1)
+
+
+def snip_continuum(counts: np.ndarray, iterations=20, decreasing=True) -> np.ndarray:
+    """
+    SNIP (Statistics-sensitive Non-linear Iterative Peak-clipping) continuum estimate.
+    The counts are compressed with the LLS operator log(log(sqrt(y + 1) + 1) + 1), every channel is then clipped
+    to the mean of its neighbours p channels away for p up to iterations, and the result is expanded back
+    :param iterations: Largest clipping distance in channels, about the full width of the widest peaks
+    :param decreasing: Clip from the largest distance down to 1, which gives smoother continua
+    :return: The continuum, same shape as counts
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    values = np.log(np.log(np.sqrt(np.maximum(counts, 0) + 1) + 1) + 1)
+    distances = range(iterations, 0, -1) if decreasing else range(1, iterations + 1)
+    for p in distances:
+        if 2 * p >= values.shape[-1]:
+            continue
+        neighbour_mean = (values[..., :-2 * p] + values[..., 2 * p:]) / 2
+        np.minimum(values[..., p:-p], neighbour_mean, out=values[..., p:-p])
+    return (np.exp(np.exp(values) - 1) - 1) ** 2 - 1
+
+
+def snip(counts: np.ndarray, iterations=20, decreasing=True) -> np.ndarray:
+    """
+    Continuum removal: the counts minus their SNIP continuum, see snip_continuum
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    return counts - snip_continuum(counts, iterations=iterations, decreasing=decreasing)
+
+
+FILTERS = {
+    "gauss": gaussian,
+    "savgol": savitzky_golay,
+    "snip": snip,
+}
+
+
+@profiled
+def apply_filter(counts: np.ndarray, method="gauss", return_noise=False, **params):
+    """
+    Applies a filter of the bank to a spectrum or stack
+    :param counts: A spectrum or an (n_spectra x channels) stack
+    :param method: One of FILTERS: "gauss", "savgol" or "snip"
+    :param return_noise: Also return the noise levels of each spectrum before and after filtering
+    :param params: Parameters of the filter function
+    :return: The filtered counts, or (filtered counts, (n_spectra,) initial noise, (n_spectra,) resulting noise)
+    """
+    if method not in FILTERS:
+        raise ValueError(f"Unknown filter '{method}', expected one of {', '.join(FILTERS)}")
+    filtered = FILTERS[method](counts, **params)
+    if return_noise:
+        return filtered, estimate_noise(counts), estimate_noise(filtered)
+    return filtered
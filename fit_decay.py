@@ -1,8 +1,22 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit, differential_evolution
+from detector_manager import Detector
+from roi import RoiIntegrator
+from spectrum_stack import SpectrumStack
+from instrumentation import profiled
 
-INPUT_PATH = "D:\Anton\Desktop (D)\Shots_processing\AREAS_FITTED\SmallDet_Shot_14_areas_channel2700to2790.txt"
+"""
+Decay curve fitting.
+Initial parameters come from a weighted log-linear regression (one isotope) or from variable projection
+over a grid of decay times with the amplitudes solved linearly (two isotopes). The global
+differential_evolution search is only used when the local fit from these guesses fails.
+scipy and matplotlib are imported on first use.
+
+Usage:
+python fit_decay.py
+(!) Edit INPUT_PATH to point at an area file written by peak_areas.py
+"""
+
+INPUT_PATH = "D:\\Anton\\Desktop (D)\\Shots_processing\\AREAS_FITTED\\SmallDet_Shot_14_areas_channel2700to2790.txt"
 
 
 # Функции экспоненциального распада
@@ -15,67 +29,324 @@ def decay_model_double(t, A1, tau1, A2, tau2):
     return A1 * np.exp(-t / tau1) + A2 * np.exp(-t / tau2)
 
 
-# Читаем данные
-with open(INPUT_PATH, 'r') as inp:
-    lines = inp.readlines()
+MODELS = {1: decay_model_single, 2: decay_model_double}
+
+
+class DecayFitResult:
+    """
+    Result of a decay fit. params are (A, tau) or (A1, tau1, A2, tau2)
+    """
+    __slots__ = ("n_components", "params", "errors", "covariance", "method", "success")
+
+    def __init__(self, n_components, params, errors, covariance, method, success):
+        self.n_components = n_components
+        self.params = params
+        self.errors = errors
+        self.covariance = covariance
+        self.method = method
+        self.success = success
+
+    @property
+    def model(self):
+        return MODELS[self.n_components]
+
+    @property
+    def amplitudes(self) -> np.ndarray:
+        return self.params[0::2]
+
+    @property
+    def taus(self) -> np.ndarray:
+        return self.params[1::2]
+
+    @property
+    def half_lives(self) -> np.ndarray:
+        return np.log(2) * self.taus
+
+    @property
+    def half_life_errors(self) -> np.ndarray:
+        return np.log(2) * self.errors[1::2]
+
+    @property
+    def activity_0(self) -> float:
+        return float(np.sum(self.amplitudes / self.taus))
+
+
+def read_area_file(path: str) -> (np.ndarray, np.ndarray):
+    """
+    Reads a "time<TAB>area" file written by peak_areas.py
+    """
+    data = np.loadtxt(path, ndmin=2)
+    return data[:, 0], data[:, 1]
+
+
+def weighted_log_linear(time: np.ndarray, values: np.ndarray, weights: np.ndarray) -> (np.ndarray, np.ndarray,
+                                                                                     np.ndarray, np.ndarray):
+    """
+    Weighted linear regression of ln(values) against time for many series at once.
+    Non-positive values are ignored
+    :param time: (m,) times
+    :param values: (n_series x m) values
+    :param weights: (n_series x m) weights, the inverse variances of ln(values)
+    :return: intercepts, slopes and their standard errors, shape (n_series,)
+    """
+    valid = values > 0
+    w = np.where(valid, weights, 0.0)
+    log_y = np.log(np.where(valid, values, 1.0))
+
+    sw = w.sum(axis=1)
+    swt = (w * time).sum(axis=1)
+    swtt = (w * time ** 2).sum(axis=1)
+    swy = (w * log_y).sum(axis=1)
+    swty = (w * time * log_y).sum(axis=1)
+    determinant = sw * swtt - swt ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (sw * swty - swt * swy) / determinant
+        intercept = (swtt * swy - swt * swty) / determinant
+        slope_error = np.sqrt(sw / determinant)
+        intercept_error = np.sqrt(swtt / determinant)
+    return intercept, slope, intercept_error, slope_error
+
+
+def log_linear_guess(time: np.ndarray, intensities: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Weighted regression of ln(intensity) against time for many series at once.
+    With Poisson statistics var(ln y) ~ 1 / y, so each point is weighted by its intensity
+    :param time: (m,) measurement times
+    :param intensities: (n_series x m) intensities
+    :return: amplitudes A and decay times tau, shape (n_series,)
+    """
+    y = np.atleast_2d(intensities)
+    intercept, slope, _, _ = weighted_log_linear(time, y, y)
+    with np.errstate(divide="ignore"):
+        return np.exp(intercept), -1 / slope
+
+
+def variable_projection_guess(time: np.ndarray, intensity: np.ndarray, grid_size=60) -> np.ndarray:
+    """
+    Initial parameters of the double exponential: for every pair of decay times on a logarithmic grid
+    the amplitudes are solved by linear least squares, the pair with the smallest residual is returned
+    :return: A1, tau1, A2, tau2
+    """
+    span = max(time.max() - time.min(), time.max(), 1.0)
+    dt = np.min(np.diff(np.unique(time))) if len(np.unique(time)) > 1 else span
+    taus = np.geomspace(max(dt / 5, 1.0), span * 20, grid_size)
+    basis = np.exp(-time / taus[:, np.newaxis])
+
+    i, j = np.triu_indices(grid_size, k=1)
+    b1, b2 = basis[i], basis[j]
+    g11, g22, g12 = (b1 * b1).sum(axis=1), (b2 * b2).sum(axis=1), (b1 * b2).sum(axis=1)
+    r1, r2 = b1 @ intensity, b2 @ intensity
+    determinant = g11 * g22 - g12 ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a1 = (g22 * r1 - g12 * r2) / determinant
+        a2 = (g11 * r2 - g12 * r1) / determinant
+    residuals = ((intensity - a1[:, np.newaxis] * b1 - a2[:, np.newaxis] * b2) ** 2).sum(axis=1)
+    residuals[~np.isfinite(residuals) | (a1 < 0) | (a2 < 0)] = np.inf
+
+    best = np.argmin(residuals)
+    if not np.isfinite(residuals[best]):
+        return None
+    return np.array([a1[best], taus[i[best]], a2[best], taus[j[best]]])
+
+
+def global_search(time: np.ndarray, intensity: np.ndarray, n_components: int) -> np.ndarray:
+    """
+    differential_evolution over the parameter bounds, used when the analytic start fails
+    """
+    model = MODELS[n_components]
+
+    # Функция потерь
+    def loss(params):
+        return np.sum((model(time, *params) - intensity) ** 2)
+
+    from scipy.optimize import differential_evolution
+    bounds = [(0, max(intensity)), (1, max(time))] * n_components
+    return differential_evolution(loss, bounds).x
+
+
+def _local_fit(time, intensity, n_components, p0, sigma) -> DecayFitResult | None:
+    from scipy.optimize import curve_fit
+    try:
+        params, covariance = curve_fit(MODELS[n_components], time, intensity, p0=p0, sigma=sigma,
+                                       absolute_sigma=sigma is not None, maxfev=10000)
+    except (RuntimeError, ValueError):
+        return None
+    errors = np.sqrt(np.diag(covariance))
+    if not (np.all(np.isfinite(params)) and np.all(np.isfinite(errors)) and np.all(params[1::2] > 0)):
+        return None
+    if n_components == 2 and params[1] > params[3]:
+        order = [2, 3, 0, 1]
+        params, errors, covariance = params[order], errors[order], covariance[np.ix_(order, order)]
+    return DecayFitResult(n_components, params, errors, covariance, method="analytic", success=True)
+
+
+@profiled
+def fit_decay(time, intensity, n_components=1, sigma=None, p0=None) -> DecayFitResult:
+    """
+    Fits a single (n_components=1) or double (n_components=2) exponential decay
+    :param time: Measurement times
+    :param intensity: Measured intensities (areas)
+    :param n_components: Number of decaying isotopes
+    :param sigma: Uncertainties of the intensities (optional)
+    :param p0: Initial parameters. If not given, they are estimated analytically
+    :return: DecayFitResult
+    """
+    if n_components not in MODELS:
+        raise ValueError("n_components should be 1 or 2")
+    time = np.asarray(time, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+
+    if p0 is None:
+        if n_components == 1:
+            amplitude, tau = log_linear_guess(time, intensity)
+            p0 = np.array([amplitude[0], tau[0]])
+        else:
+            p0 = variable_projection_guess(time, intensity)
+
+    result = None
+    if p0 is not None and np.all(np.isfinite(p0)) and np.all(np.asarray(p0)[1::2] > 0):
+        result = _local_fit(time, intensity, n_components, p0, sigma)
+    if result is None:
+        result = _local_fit(time, intensity, n_components, global_search(time, intensity, n_components), sigma)
+        if result is not None:
+            result.method = "global"
+    if result is None:
+        n_params = 2 * n_components
+        result = DecayFitResult(n_components, np.full(n_params, np.nan), np.full(n_params, np.nan),
+                                np.full((n_params, n_params), np.nan), method="failed", success=False)
+    return result
+
+
+@profiled
+def fit_decay_batch(time, intensities, n_components=1, sigmas=None) -> list[DecayFitResult]:
+    """
+    Fits many area series measured at the same times
+    :param time: (m,) measurement times
+    :param intensities: (n_series x m) intensities
+    :param n_components: Number of decaying isotopes
+    :param sigmas: (n_series x m) uncertainties (optional)
+    :return: A DecayFitResult per series
+    """
+    time = np.asarray(time, dtype=np.float64)
+    intensities = np.atleast_2d(np.asarray(intensities, dtype=np.float64))
+    if n_components == 1:
+        amplitudes, taus = log_linear_guess(time, intensities)
+        starts = np.column_stack([amplitudes, taus])
+    else:
+        starts = [None] * len(intensities)
+    return [fit_decay(time, intensity, n_components, sigma=None if sigmas is None else sigmas[i], p0=starts[i])
+            for i, intensity in enumerate(intensities)]
+
+
+class HalfLifeMap:
+    """
+    Decay constants and half-lives for every energy bin or ROI of a shot.
+    Bins without a significant decay (decay constant not positive) have an infinite half-life
+    """
+    __slots__ = ("energies", "channels", "decay_constants", "decay_constant_errors", "initial_rates", "valid")
+
+    def __init__(self, energies, channels, decay_constants, decay_constant_errors, initial_rates, valid):
+        self.energies = energies
+        self.channels = channels
+        self.decay_constants = decay_constants
+        self.decay_constant_errors = decay_constant_errors
+        self.initial_rates = initial_rates
+        self.valid = valid
+
+    @property
+    def half_lives(self) -> np.ndarray:
+        with np.errstate(divide="ignore"):
+            return np.where(self.decay_constants > 0, np.log(2) / self.decay_constants, np.inf)
+
+    @property
+    def half_life_errors(self) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.decay_constants > 0,
+                            np.log(2) * self.decay_constant_errors / self.decay_constants ** 2, np.inf)
+
 
-time, intensity = [], []
-for line in lines:
-    t, i = line.split()
-    time.append(int(t))
-    intensity.append(float(i))
+def get_mid_times(times: np.ndarray) -> np.ndarray:
+    """
+    Times of the middle of each measurement, counted from the start of the first one
+    :param times: (n_spectra x 2) live and real times of consecutive measurements
+    """
+    real_times = np.asarray(times, dtype=np.float64)[:, 1]
+    return np.cumsum(real_times) - real_times / 2
 
-time = np.array(time)
-intensity = np.array(intensity)
 
+@profiled
+def fit_half_life_map(counts: np.ndarray, times: np.ndarray, detector: Detector, rois=None, bin_width=1,
+                      min_points=3) -> HalfLifeMap:
+    """
+    Fits a decay constant to every energy bin (or every ROI) of a time-ordered spectrum stack at once,
+    with a weighted log-linear fit of the count rates
+    :param counts: (n_spectra x channels) counts in time order, e.g. SpectrumStack.counts
+    :param times: (n_spectra x 2) live and real times of the spectra
+    :param detector: The detector, for the energy scale
+    :param rois: (n_rois x 2) channel ROIs to fit instead of the energy bins, using their net areas
+    :param bin_width: Number of channels summed into one energy bin
+    :param min_points: Minimum number of spectra with nonzero counts for a bin to be fitted
+    :return: HalfLifeMap
+    """
+    times = np.asarray(times, dtype=np.float64)
+    if rois is not None:
+        # Net ROI areas, weighted by their inverse relative variance
+        rois = np.asarray(rois, dtype=np.int64).reshape(-1, 2)
+        areas = RoiIntegrator(counts).areas(rois)
+        values = areas.net
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weights = np.nan_to_num(areas.net ** 2 / areas.net_errors ** 2)
+        channels = rois.mean(axis=1)
+    else:
+        n_bins = counts.shape[1] // bin_width
+        values = np.asarray(counts[:, :n_bins * bin_width], dtype=np.float64)
+        values = values.reshape(len(values), n_bins, bin_width).sum(axis=2)
+        weights = values
+        channels = np.arange(n_bins) * bin_width + (bin_width - 1) / 2
 
-# Функция потерь
-def loss(params, model):
-    return np.sum((model(time, *params) - intensity) ** 2)
+    rates = (values / times[:, 0, np.newaxis]).T
+    intercept, slope, _, slope_error = weighted_log_linear(get_mid_times(times), rates, weights.T)
+    valid = ((values > 0).sum(axis=0) >= min_points) & np.isfinite(slope) & np.isfinite(slope_error)
 
+    decay_constants = np.where(valid, -slope, np.nan)
+    return HalfLifeMap(energies=detector.calibration.calibrate(channels),
+                       channels=channels,
+                       decay_constants=decay_constants,
+                       decay_constant_errors=np.where(valid, slope_error, np.nan),
+                       initial_rates=np.where(valid, np.exp(intercept), np.nan),
+                       valid=valid)
 
-# Выбор модели: 1 или 2 изотопа
-use_double_exponential = True  # Переключатель
 
-if use_double_exponential:
-    model = decay_model_double
-    bounds = [(0, max(intensity)), (1, max(time)), (0, max(intensity)), (1, max(time))]
-else:
-    model = decay_model_single
-    bounds = [(0, max(intensity)), (1, max(time))]
+def half_life_map_from_stack(stack: SpectrumStack, rois=None, bin_width=1) -> HalfLifeMap:
+    return fit_half_life_map(stack.counts, stack.times, stack.detector, rois=rois, bin_width=bin_width)
 
-# Поиск оптимального начального приближения
-result = differential_evolution(loss, bounds, args=(model,))
 
-# Аппроксимация
-params, covariance = curve_fit(model, time, intensity, p0=result.x)
+def print_results(result: DecayFitResult) -> None:
+    for i, (amplitude, tau, half_life) in enumerate(zip(result.amplitudes, result.taus, result.half_lives)):
+        index = i + 1 if result.n_components > 1 else ""
+        print(f"A{index} = {amplitude:.2f}, τ{index} = {tau:.2f} sec")
+        print(f"T_half{index} = {half_life:.2f} sec")
+    print()
+    print(f"Activity at t=0: {result.activity_0:.2f} Bq")
 
-# Вывод результатов
-if use_double_exponential:
-    A1_opt, tau1_opt, A2_opt, tau2_opt = params
-    print(f"A1 = {A1_opt:.2f}, τ1 = {tau1_opt:.2f} sec")
-    print(f"A2 = {A2_opt:.2f}, τ2 = {tau2_opt:.2f} sec")
-    print(f"T_half1 = {0.693 * tau1_opt:.2f} sec")
-    print(f"T_half2 = {0.693 * tau2_opt:.2f} sec\n")
-    activity_0 = (A1_opt / tau1_opt) + (A2_opt / tau2_opt)
-    print(f"Activity at t=0: {activity_0:.2f} Bq")
 
-else:
-    A_opt, tau_opt = params
-    print(f"A = {A_opt:.2f}, τ = {tau_opt:.2f} sec")
-    print(f"T_half = {0.693 * tau_opt:.2f} sec\n")
-    activity_0 = A_opt / tau_opt
-    print(f"Activity at t=0: {activity_0:.2f} Bq")
+def plot_fit(time, intensity, result: DecayFitResult) -> None:
+    import matplotlib.pyplot as plt
+    t_fit = np.linspace(np.min(time), np.max(time), len(time))
+    plt.scatter(time, intensity, label="Input Data", color="red")
+    plt.plot(t_fit, result.model(t_fit, *result.params), label="Approximation", linestyle="--")
+    plt.xlabel("Time (sec)")
+    plt.ylabel("Intensity")
+    plt.yscale("log")
+    plt.legend()
+    plt.show()
 
-# График
-t_fit = np.linspace(time.min(), time.max(), len(time))
-I_fit = model(t_fit, *params)
 
+if __name__ == "__main__":
+    # Выбор модели: 1 или 2 изотопа
+    use_double_exponential = True  # Переключатель
 
-plt.scatter(time, intensity, label="Input Data", color="red")
-plt.plot(t_fit, I_fit, label="Approximation", linestyle="--")
-plt.xlabel("Time (sec)")
-plt.ylabel("Intensity")
-plt.yscale("log")
-plt.legend()
-plt.show()
+    time, intensity = read_area_file(INPUT_PATH)
+    result = fit_decay(time, intensity, n_components=2 if use_double_exponential else 1)
+    print_results(result)
+    plot_fit(time, intensity, result)
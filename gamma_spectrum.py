@@ -2,18 +2,35 @@ import re
 import numpy as np
 import misc
 import config
-import csv
 from config import DetectorType
-from scipy.ndimage import gaussian_filter1d
+import filters
 from detector_manager import Detector
 import os
 import json
+import spe_reader
+import export
+from spectrum_stack import SpectrumStack
+from result_cache import ResultCache
+import instrumentation
+from instrumentation import profiled
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
 class GammaSpectrum:
     """
-    A GammaSpectrum object used for spectrum processing
+    A GammaSpectrum object used for spectrum processing.
+    Counts, channels, energies and times are kept as contiguous numpy arrays.
+    A .Spe spectrum loaded with lazy=True only reads its header: the counts and footer are parsed from source_path
+    on first access and can be released again with release_counts.
     """
+    __slots__ = ("name", "detector", "header", "_footer", "times", "_counts", "length", "channels", "energies",
+                 "file_extension", "header_end_index", "footer_start_index", "source_path", "zeros_dropped")
+
+    COUNTS_DTYPE = np.uint32
+    SUM_DTYPE = np.uint64
+
     TIME_LINE = config.spectra_files["time_line"]
 
     HEADER_END = config.spectra_files["header_end"]
@@ -23,141 +40,258 @@ class GammaSpectrum:
         self.name = None
         self.detector = None
         self.header = None
-        self.footer = None
+        self._footer = None
         self.times = None
-        self.counts = None
+        self._counts = None
         self.length = None
         self.channels = None
         self.energies = None
         self.file_extension = None
         self.header_end_index = None
         self.footer_start_index = None
+        self.source_path = None
+        # True for background-subtracted counts: their zeros are dropped channels, written as 0 (not 0.0)
+        # like in older versions. Reset when the counts are replaced
+        self.zeros_dropped = False
+
+    @property
+    def counts(self) -> np.ndarray:
+        if self._counts is None and self.source_path is not None:
+            self._load_data()
+        return self._counts
+
+    @counts.setter
+    def counts(self, value: np.ndarray) -> None:
+        self._counts = value
+        self.zeros_dropped = False
+
+    @property
+    def footer(self) -> bytes:
+        if self._footer is None and self.source_path is not None:
+            self._load_data()
+        return self._footer
+
+    @footer.setter
+    def footer(self, value: bytes) -> None:
+        self._footer = value
+
+    @property
+    def is_loaded(self) -> bool:
+        """
+        False for a lazily loaded spectrum whose counts have not been parsed (or were released)
+        """
+        return self._counts is not None
+
+    @profiled
+    def _load_data(self) -> None:
+        spe = spe_reader.read_spe(self.source_path)
+        self._counts = spe.counts
+        self._footer = spe.footer
+        self.footer_start_index = spe.data_end
+
+    def release_counts(self) -> None:
+        """
+        Frees the counts and footer of a lazily loaded spectrum, they are parsed again on the next access
+        """
+        if self.source_path is None:
+            raise ValueError(f"{self.name} was not loaded lazily, its counts can not be released")
+        self._counts = None
+        self._footer = None
 
-    def load(self, path: str, csv_delimiter=","):
+    @profiled
+    def load(self, path: str, csv_delimiter=",", lazy=False, detector_type=None):
         """
         Loads a new GammaSpectrum from a file depending on its extension and contents, pre-filling its properties
         :param csv_delimiter: column separator in the .csv file
         :param path: The path to the .Spe file
+        :param lazy: For .Spe files, only read the header. The counts are parsed on first access
+        :param detector_type: The detector of a .Spe or .csv file (default: derived from the path,
+        which prompts the user if the path names no detector). .json and .npz files store their detector
         :return:
         """
         delimiter = csv_delimiter
         self.name, self.file_extension = os.path.splitext(
             os.path.basename(path))
+        if instrumentation.ENABLED and self.file_extension != ".Spe":
+            # .Spe files are counted by spe_reader
+            instrumentation.add_bytes_read(os.path.getsize(path))
         if self.file_extension == ".json":
             with open(path) as f:
                 file_contents = json.load(f)
             self.detector = Detector(misc.get_detector_from_filename(file_contents["metadata"]["detector"]))
-            self.times = file_contents["metadata"]["spectrum_recording_times"]
-            self.counts = file_contents["data"]["counts"]
-            self.channels = file_contents["data"]["channels"]
-            self.energies = file_contents["data"]["energies"]
+            if file_contents["metadata"]["spectrum_recording_times"] is not None:
+                self.times = np.asarray(file_contents["metadata"]["spectrum_recording_times"])
+            if file_contents["metadata"].get("format") == export.SPARSE_FORMAT:
+                # Only the nonzero channels are stored, see sparse_spectrum.py. The file name has a suffix
+                self.name = file_contents["metadata"]["spectrum_name"]
+                data = file_contents["data"]
+                self.counts = sparse_to_dense(data["length"], np.asarray(data["indices"], dtype=np.int64),
+                                              np.asarray(data["counts"]))
+                self.fill_channels()
+            else:
+                self.counts = np.asarray(file_contents["data"]["counts"])
+                self.channels = np.asarray(file_contents["data"]["channels"])
+                if file_contents["data"]["energies"] is not None:
+                    self.energies = np.asarray(file_contents["data"]["energies"], dtype=np.float64)
+
+        elif self.file_extension == export.NPZ_EXTENSION:
+            with np.load(path) as arrays:
+                self.name = str(arrays["name"])
+                self.detector = Detector(misc.get_detector_from_filename(str(arrays["detector"])))
+                if "indices" in arrays:
+                    self.counts = sparse_to_dense(int(arrays["length"]), arrays["indices"], arrays["values"])
+                    self.fill_channels()
+                else:
+                    self.counts = arrays["counts"]
+                    self.channels = arrays["channels"]
+                if "times" in arrays:
+                    self.times = arrays["times"]
+                if "energies" in arrays:
+                    self.energies = arrays["energies"]
+
+        elif self.file_extension == ".Spe" and lazy:
+            self.detector = Detector(detector_type or misc.get_detector_from_filename(path))
+            spe = spe_reader.read_spe_header(path)
+            self.source_path = path
+            self.header = spe.header
+            self.header_end_index = spe.data_start
+            self.times = spe.times
+            first_channel, last_channel = spe_reader.parse_channel_range(spe.header, spe.data_start)
+            self.length = last_channel - first_channel + 1
+            self.channels = np.arange(self.length)
+            self.fill_energies()
+            return self
+
+        elif self.file_extension == ".Spe":
+            self.detector = Detector(detector_type or misc.get_detector_from_filename(path))
+            spe = spe_reader.read_spe(path)
+            self.header = spe.header
+            self.footer = spe.footer
+            self.header_end_index = spe.data_start
+            self.footer_start_index = spe.data_end
+            self.times = spe.times
+            self.counts = spe.counts
+            self.fill_channels()
 
         else:
-            self.detector = Detector(misc.get_detector_from_filename(path))
+            self.detector = Detector(detector_type or misc.get_detector_from_filename(path))
 
             with open(path) as f:
                 lines = f.read().splitlines()
 
-            if self.file_extension == ".Spe":
-                self.header_end_index = next((i for i, line in enumerate(lines) if
-                                              self.HEADER_END in line)) + 2
-                # +2 Because there is one more extra header line after the $Data line
-                # plus the $Data line should also be incuded
-                self.footer_start_index = next((i for i, line in enumerate(lines[::-1]) if
-                                                self.FOOTER_START in line)) + 1
-                # +1 because the $ROI line should also be included
-
-                self.header = lines[:self.header_end_index]
-                self.footer = lines[-self.footer_start_index:]
-
-                self.times = list(map(int, lines[self.TIME_LINE].split()))
-
-                self.counts = [int(line) for line in lines[self.header_end_index:-self.footer_start_index]]
-                self.length = len(self.counts)
-                self.fill_channels()
-
-            elif self.file_extension == ".csv":
-                file_channels, file_counts = zip(*[line.split(delimiter) for line in lines])
-                self.channels = list(map(float, file_channels))
-                self.counts = list(map(float, file_counts))
+            if self.file_extension == ".csv":
+                table = np.loadtxt(lines, delimiter=delimiter, dtype=np.float64, ndmin=2)
+                self.channels = table[:, 0]
+                self.counts = table[:, 1]
             else:
                 raise ValueError("Unsupported file format")
 
-        if not self.energies and self.detector.energy_scale:
+        self.length = len(self.counts)
+        if self.energies is None and self.detector.energy_scale is not None:
             self.fill_energies()
 
         return self
 
-    def apply_filtering(self):
-        def estimate_noise(spectrum):
-            diffs = np.diff(spectrum)  # Разности соседних значений
-            noise_level = np.median(np.abs(diffs)) / 0.6745  # Оценка стандартного отклонения шума
-            return noise_level
+    def load_from_stack(self, stack: SpectrumStack, index: int):
+        """
+        Loads a GammaSpectrum from a row of a SpectrumStack. The counts stay a view of the memory-mapped stack
+        :param stack: An opened SpectrumStack
+        :param index: The row of the stack
+        :return:
+        """
+        self.name = stack.names[index]
+        self.file_extension = ".Spe"
+        self.detector = stack.detector
+        self.header = stack.headers[index]
+        self.footer = stack.footers[index]
+        self.times = stack.times[index]
+        self.counts = stack.counts[index]
+        self.length = len(self.counts)
+        self.fill_channels()
+        self.fill_energies()
+        return self
+
+    @profiled
+    def apply_filtering(self, method="gauss", **params):
+        """
+        Filters the spectrum in place, see SpectrumProcessor.filter_multiple
+        :param method: "gauss" (default: sigma=1), "savgol" or "snip", see filters.py
+        :param params: Parameters of the filter
+        """
+        initial_noise, resulting_noise = SpectrumProcessor.filter_multiple([self], method=method, **params)
+        print(f"Initial noise level: {initial_noise[0]:.2f}")
+        print(f"Resulting noise level: {resulting_noise[0]:.2f}")
+
+    def __getstate__(self):
+        state = {attr: getattr(self, attr) for attr in self.__slots__}
+        # Energies viewing the detector's shared scale are restored from the detector instead of being pickled
+        if self.energies is not None and self.detector is not None and self.energies.base is self.detector.energy_scale:
+            state["energies"] = "detector"
+        return state
+
+    def __setstate__(self, state):
+        for attr, value in state.items():
+            setattr(self, attr, value)
+        if isinstance(self.energies, str):
+            self.fill_energies()
 
-        print(f"Initial noise level: {estimate_noise(self.counts):.2f}")
-        print("Filtering data...")
-        self.counts = list(gaussian_filter1d(self.counts, sigma=1))
-        self.name += "_filtered"
-        print(f"Resulting noise level: {estimate_noise(self.counts):.2f}")
+    def copy(self) -> "GammaSpectrum":
+        """
+        Returns a shallow copy of the spectrum: the arrays are shared, replace them instead of modifying in place
+        """
+        new = GammaSpectrum()
+        for attr in self.__slots__:
+            setattr(new, attr, getattr(self, attr))
+        return new
 
     def fill_channels(self):
         """
         Fills the spectrum channels
         :return:
         """
-        self.channels = list(range(len(self.counts)))
+        self.channels = np.arange(len(self.counts))
 
     def fill_energies(self):
-        self.energies = self.detector.energy_scale[:self.length]
+        """
+        Sets the energies from the detector's energy calibration, a read-only view of its shared energy scale
+        """
+        self.energies = self.detector.calibration.get_energies(self.length)
 
     def update_times(self, new_times: list) -> None:
         """
-        Replaces the data acquisition times in the GammaDetector's header (for .Spe files)
+        Replaces the data acquisition times in the GammaDetector's header (for .Spe files, others have no header)
         :param new_times: Values for replacing the existing times
         """
-        self.header[self.TIME_LINE] = f"{new_times[0]} {new_times[1]}"
+        if self.header is not None:
+            self.header = spe_reader.replace_times(self.header, new_times)
 
+    @profiled
     def save_spe(self, out_path: str) -> None:
         if not os.path.exists(os.path.dirname(out_path)):
             os.makedirs(os.path.dirname(out_path))
 
-        with open(out_path, "w") as f:
-            f.writelines(line + "\n" for line in self.header)
-            f.writelines(line + "\n" for line in map(str, self.counts))
-            f.writelines(line + "\n" for line in self.footer)
-
-        print(f"File saved: {out_path}")
+        written = export.write_output(self, out_path, lambda: export.render_spe(self), "save_spe", binary=True,
+                                      cache=SpectrumProcessor.result_cache)
+        print(f"File {'saved' if written else 'up to date'}: {out_path}")
 
+    @profiled
     def save_raw(self, out_directory: str, output_energies=False, filename_suffix="") -> None:
-        data = self.energies if output_energies else self.channels
         name_suffix = f"{filename_suffix}.csv"
         out_filename = self.name + name_suffix
         out_path = os.path.join(out_directory, out_filename)
         if not os.path.exists(out_directory):
             os.makedirs(out_directory)
-        with open(out_path, "w", newline='') as f:
-            writer = csv.writer(f)
-            for d, cnt in zip(data, self.counts):
-                writer.writerow([d, cnt])
-
-        print(f"File saved: {out_path}")
 
-    def save_json(self, out_directory: str, filename_suffix=""):
-        metadata = {
-            "spectrum_name": self.name,
-            "detector": self.detector.name,
-            "spectrum_recording_times": self.times
-        }
-        data = {
-            "counts": self.counts,
-            "channels": self.channels,
-            "energies": self.energies,
-        }
-        json_data = {
-            "metadata": metadata,
-            "data": data
-        }
+        written = export.write_output(self, out_path, lambda: export.render_csv(self, output_energies), "save_raw",
+                                      {"output_energies": output_energies}, newline="",
+                                      cache=SpectrumProcessor.result_cache)
+        print(f"File {'saved' if written else 'up to date'}: {out_path}")
 
+    @profiled
+    def save_json(self, out_directory: str, filename_suffix="", compact=False):
+        """
+        :param compact: Write compact JSON instead of the indented format, see export.render_json
+        """
         name_suffix = f"{filename_suffix}.json"
         out_filename = self.name + name_suffix
         out_path = os.path.join(out_directory, out_filename)
@@ -165,74 +299,447 @@ class GammaSpectrum:
         if not os.path.exists(out_directory):
             os.makedirs(out_directory)
 
-        with open(out_path, "w") as f:
-            json.dump(json_data, f, indent=4)
+        written = export.write_output(self, out_path, lambda: export.render_json(self, compact), "save_json",
+                                      {"compact": compact}, cache=SpectrumProcessor.result_cache)
+        print(f"File {'saved' if written else 'up to date'}: {out_path}")
+
+    @profiled
+    def save_npz(self, out_directory: str, filename_suffix="") -> None:
+        """
+        Saves the spectrum arrays as a binary .npz file, see export.write_npz
+        """
+        out_path = os.path.join(out_directory, self.name + filename_suffix + export.NPZ_EXTENSION)
+        if not os.path.exists(out_directory):
+            os.makedirs(out_directory)
 
+        export.write_npz(self, out_path)
         print(f"File saved: {out_path}")
 
 
+class BackgroundCache:
+    """
+    Keeps the parsed background spectrum of each detector in memory together with its scaled versions,
+    so the background file is read and preprocessed once per run.
+    Entries are keyed by the detector type and the background file's mtime, a changed file is reloaded.
+    """
+
+    def __init__(self, max_scaled=64):
+        """
+        :param max_scaled: Maximum number of scaled background arrays kept, least recently used are evicted first
+        """
+        self.max_scaled = max_scaled
+        self._backgrounds = {}
+        self._zero_replaced = {}
+        self._scaled = OrderedDict()
+        self._lock = threading.Lock()
+
+    @profiled
+    def get_background(self, detector: Detector) -> (GammaSpectrum, float):
+        """
+        Returns the (shared, not to be modified) background spectrum of the detector and its mtime
+        """
+        mtime = os.path.getmtime(detector.bg_path)
+        with self._lock:
+            cached = self._backgrounds.get(detector.type)
+            if cached is not None and cached[1] == mtime:
+                return cached
+            background_spectrum = GammaSpectrum().load(detector.bg_path)
+            background_spectrum.counts.setflags(write=False)
+            self._backgrounds[detector.type] = background_spectrum, mtime
+            self._zero_replaced.pop(detector.type, None)
+            for key in [key for key in self._scaled if key[0] == detector.type]:
+                del self._scaled[key]
+            return background_spectrum, mtime
+
+    def get_counts(self, detector: Detector, replace_zeros=False) -> np.ndarray:
+        """
+        Returns the unscaled background counts of the detector
+        :param replace_zeros: Replace zero background channels by the smallest nonzero background count
+        :return: Read-only array of background counts
+        """
+        background_spectrum, mtime = self.get_background(detector)
+        if not replace_zeros:
+            return background_spectrum.counts
+        with self._lock:
+            cached = self._zero_replaced.get(detector.type)
+            if cached is not None and cached[1] == mtime:
+                return cached[0]
+
+        bg_counts = background_spectrum.counts
+        replaced = np.where(bg_counts > 0, bg_counts, bg_counts[bg_counts > 0].min())
+        replaced.setflags(write=False)
+        with self._lock:
+            self._zero_replaced[detector.type] = replaced, mtime
+        return replaced
+
+    def get_scaled(self, detector: Detector, spectrum_time: int | float, replace_zeros=False) -> np.ndarray:
+        """
+        Returns the background counts scaled to the given measurement time
+        :param detector: The detector whose background is used
+        :param spectrum_time: Measurement time to scale the background to
+        :param replace_zeros: Replace zero background channels by the smallest nonzero background count
+        :return: Read-only array of scaled background counts
+        """
+        background_spectrum, mtime = self.get_background(detector)
+        key = (detector.type, mtime, spectrum_time, replace_zeros)
+        with self._lock:
+            scaled = self._scaled.get(key)
+            if scaled is not None:
+                self._scaled.move_to_end(key)
+                return scaled
+
+        scaled = self.get_counts(detector, replace_zeros) * (spectrum_time / detector.bg_times[0])
+        scaled.setflags(write=False)
+
+        with self._lock:
+            self._scaled[key] = scaled
+            while len(self._scaled) > self.max_scaled:
+                self._scaled.popitem(last=False)
+        return scaled
+
+    def clear(self) -> None:
+        with self._lock:
+            self._backgrounds.clear()
+            self._zero_replaced.clear()
+            self._scaled.clear()
+
+
+def sparse_to_dense(length: int, indices: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Counts of all channels from the indices and values of the nonzero channels
+    """
+    counts = np.zeros(length, dtype=values.dtype)
+    counts[indices] = values
+    return counts
+
+
+def load_spectrum(path: str, lazy=False, detector_type=None) -> GammaSpectrum:
+    return GammaSpectrum().load(path, lazy=lazy, detector_type=detector_type)
+
+
+def get_detector_types(files: list) -> list:
+    """
+    Detector types of spectrum files for GammaSpectrum.load, derived on the calling thread so that loading them
+    on a pool never prompts. If a path names no detector, the user is asked once for its whole directory
+    :return: For every file its DetectorType, None for .json and .npz files (their detector is stored in the file),
+    or the exception raised if the detector could not be derived
+    """
+    detector_types = []
+    directory_types = {}
+    for path in files:
+        if os.path.splitext(path)[1] in (".json", export.NPZ_EXTENSION):
+            detector_types.append(None)
+            continue
+        detector_type = misc.find_detector_in_filename(path)
+        if detector_type is None:
+            directory = os.path.dirname(path)
+            if directory not in directory_types:
+                try:
+                    directory_types[directory] = misc.get_detector_from_filename(path)
+                except ValueError as e:
+                    directory_types[directory] = e
+            detector_type = directory_types[directory]
+        detector_types.append(detector_type)
+    return detector_types
+
+
+def get_file_number(name: str) -> str:
+    return re.search(r"(\d{3})", name).group(1)
+
+
+def select_range(items: list, get_name, start=0, end=-1) -> list:
+    """
+    Sorts spectra (or their files) by the running number in their name and selects a range of numbers
+    :param items: Spectra or paths
+    :param get_name: Returns the spectrum name of an item
+    :param start: First number to select (0 = from the first)
+    :param end: Last number to select (-1 = up to the last)
+    :return: The selected items, sorted by their number
+    """
+    numbered = sorted(((misc.get_spectrum_number(get_name(item)), i) for i, item in enumerate(items)))
+    selected = [items[i] for number, i in numbered if number >= start and (end < 0 or number <= end)]
+    if not selected:
+        raise ValueError(f"No spectra numbered from {start} to {'the last' if end < 0 else end}")
+    return selected
+
+
+def get_sum_dtype(*dtypes) -> np.dtype:
+    """
+    Accumulator dtype for summing counts: GammaSpectrum.SUM_DTYPE for unsigned counts (.Spe files),
+    int64 for signed integer counts (e.g. .json files) and float64 otherwise (.csv files, subtracted background)
+    """
+    if all(np.issubdtype(dtype, np.unsignedinteger) for dtype in dtypes):
+        return np.dtype(GammaSpectrum.SUM_DTYPE)
+    if all(np.issubdtype(dtype, np.integer) for dtype in dtypes):
+        return np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+
+def get_sum_name(detector: Detector, name_modifier: str, first_name: str, last_name: str) -> str:
+    return f"SumSpectra{detector.name}{name_modifier}-{get_file_number(first_name)}_to_{get_file_number(last_name)}"
+
+
 class SpectrumProcessor:
+    background_cache = BackgroundCache()
+    # On-disk cache of processing results and rendered output files, disabled until enable_result_cache is called
+    result_cache = None
+
+    @staticmethod
+    def enable_result_cache(directory=None, max_bytes=512 * 1024 ** 2) -> ResultCache:
+        """
+        Enables the on-disk result cache for background subtraction, filtering and the save_* methods
+        :param directory: The cache directory (default: ".cache" in config.processed_path)
+        :param max_bytes: Maximum total size of the cache
+        :return: The cache
+        """
+        SpectrumProcessor.result_cache = ResultCache(directory or os.path.join(config.processed_path, ".cache"),
+                                                     max_bytes=max_bytes)
+        return SpectrumProcessor.result_cache
+
+    @staticmethod
+    def disable_result_cache() -> None:
+        SpectrumProcessor.result_cache = None
+
     @staticmethod
-    def load_multiple_spectra(files: list) -> list[GammaSpectrum] | None:
-        return [GammaSpectrum().load(os.path.join(filename)) for filename in files]
+    def iter_load_spectra(files: list, workers=None, use_processes=False, max_in_flight=None, lazy=False):
+        """
+        Loads spectra concurrently, yielding them in the order of the input files
+        :param files: Paths to the spectrum files
+        :param workers: Number of pool workers (default: CPU count for processes, CPU count + 4 for threads).
+        workers=1 loads sequentially
+        :param use_processes: Use a process pool instead of a thread pool
+        :param max_in_flight: Maximum number of files being loaded or waiting to be consumed at once
+        (default: 2 * workers), keeps memory flat for large directories
+        :param lazy: Only read the headers of .Spe files, see GammaSpectrum.load
+        :return: Generator of (path, GammaSpectrum) tuples. If a file could not be loaded, the exception
+        is yielded in place of the spectrum
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1 if use_processes else min(32, (os.cpu_count() or 1) + 4)
+        if max_in_flight is None:
+            max_in_flight = 2 * workers
+
+        if workers == 1:
+            for path in files:
+                try:
+                    yield path, load_spectrum(path, lazy)
+                except Exception as e:
+                    yield path, e
+            return
+
+        # input() can not be called from the pool: detectors that have to be asked for are asked for here
+        files = list(files)
+        detector_types = get_detector_types(files)
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=workers) as executor:
+
+            def submit(path, detector_type):
+                if isinstance(detector_type, Exception):
+                    return path, detector_type
+                return path, executor.submit(load_spectrum, path, lazy, detector_type)
+
+            pending = deque()
+            inputs = zip(files, detector_types)
+            for path, detector_type in inputs:
+                pending.append(submit(path, detector_type))
+                if len(pending) >= max_in_flight:
+                    break
+            while pending:
+                path, future = pending.popleft()
+                next_input = next(inputs, None)
+                if next_input is not None:
+                    pending.append(submit(*next_input))
+                if isinstance(future, Exception):
+                    yield path, future
+                    continue
+                try:
+                    yield path, future.result()
+                except Exception as e:
+                    yield path, e
 
     @staticmethod
+    @profiled
+    def load_multiple_spectra(files: list, workers=None, use_processes=False, max_in_flight=None,
+                              lazy=False) -> list[GammaSpectrum] | None:
+        """
+        Loads spectra from multiple files in parallel, preserving the file order.
+        Files that can not be loaded are reported and skipped.
+        :param files: Paths to the spectrum files
+        :param workers: Number of pool workers
+        :param use_processes: Use a process pool instead of a thread pool
+        :param max_in_flight: Maximum number of files loaded ahead of the consumer
+        :param lazy: Only read the headers of .Spe files, see GammaSpectrum.load
+        :return: The loaded spectra
+        """
+        spectra = []
+        for path, result in SpectrumProcessor.iter_load_spectra(files, workers=workers,
+                                                                use_processes=use_processes,
+                                                                max_in_flight=max_in_flight, lazy=lazy):
+            if isinstance(result, Exception):
+                print(f"Unable to load {path}: {result}\nSkipping to next")
+            else:
+                spectra.append(result)
+        return spectra
+
+    @staticmethod
+    @profiled
+    def load_stack(path: str, start=None, end=None) -> list[GammaSpectrum]:
+        """
+        Loads spectra from a .gstack file (see spectrum_stack.py). Only the selected rows are read, when accessed
+        :param path: The path to the .gstack file
+        :param start: First file number to load (default: the first file)
+        :param end: Last file number to load (default: the last file)
+        :return: The spectra in file number order
+        """
+        stack = SpectrumStack.open(path)
+        return [GammaSpectrum().load_from_stack(stack, i) for i in range(len(stack))[stack.get_range(start, end)]]
+
+    @staticmethod
+    @profiled
     def sum_spectra(spectra: list[GammaSpectrum], name_modifier: str, start=0, end=-1) -> GammaSpectrum:
         """
-        Sums spectra counts and times from the list and returns the resulting spectrum
+        Sums spectra counts and times from the list and returns the resulting spectrum.
+        Lazily loaded spectra are only parsed if they are in the selected range, and released again after summing
         :param spectra: The spectra to sum
         :param name_modifier: The resulting file will be saved as
         "SumSpectra{detector}{name_modifier}-{name_prefix}_to_{name_suffix}.Spe"
-        :param start:
-        :param end:
+        :param start: Number of the first spectrum to sum (spectra are then sorted by their number)
+        :param end: Number of the last spectrum to sum, -1 = up to the last spectrum
+        :return: A new GammaSpectrum consisting of the summed up counts
+        """
+        if start > 0 or end > 0:
+            spectra = select_range(spectra, lambda s: s.name, start, end)
+
+        first, last = spectra[0], spectra[-1]
+        was_loaded = [spectrum.is_loaded for spectrum in spectra]
+
+        result = GammaSpectrum()
+        result.header = first.header
+        result.footer = first.footer
+        result.detector = first.detector
+        result.counts = np.zeros(len(first.counts), dtype=get_sum_dtype(first.counts.dtype))
+        # .csv files have no times
+        has_times = all(spectrum.times is not None for spectrum in spectra)
+        result.times = np.zeros_like(first.times) if has_times else None
+        for spectrum, loaded in zip(spectra, was_loaded):
+            if not np.can_cast(spectrum.counts.dtype, result.counts.dtype):
+                # Spectra loaded from different formats
+                result.counts = result.counts.astype(get_sum_dtype(result.counts.dtype, spectrum.counts.dtype))
+            result.counts += spectrum.counts
+            if has_times:
+                result.times += spectrum.times
+            if not loaded:
+                spectrum.release_counts()
+
+        if has_times:
+            result.update_times(result.times)
+        result.name = get_sum_name(result.detector, name_modifier, first.name, last.name)
+        result.file_extension = ".Spe"
+        result.length = len(result.counts)
+        result.fill_channels()
+        result.fill_energies()
+        return result
+
+    @staticmethod
+    @profiled
+    def sum_spectra_files(files, name_modifier: str, start=0, end=-1) -> GammaSpectrum:
+        """
+        Streaming version of sum_spectra: sums .Spe files one at a time into a single preallocated accumulator,
+        so only one file is held in memory at once
+        :param files: Iterable of paths to .Spe files
+        :param name_modifier: The resulting file will be saved as
+        "SumSpectra{detector}{name_modifier}-{name_prefix}_to_{name_suffix}.Spe"
+        :param start: Number of the first file to sum (files are then sorted by their number)
+        :param end: Number of the last file to sum, -1 = up to the last file
         :return: A new GammaSpectrum consisting of the summed up counts
         """
 
-        def get_file_number(file) -> str:
-            return re.search(r"(\d{3})", file).group(1)
+        def get_name(path: str) -> str:
+            return os.path.splitext(os.path.basename(path))[0]
+
+        if start > 0 or end > 0:
+            # Only the paths are listed, the files are still read one at a time
+            files = select_range(list(files), get_name, start, end)
 
-        if start > 0:
-            spectra = sorted(spectra, key=lambda s: int(re.search(r"\d{3,}$", s.name).group()))
-            first_index = next((i for i, spectrum in enumerate(spectra) if
-                                int(re.search(r"(\d{3,})$", spectrum.name).group()) == start))
-            spectra = spectra[first_index:]
+        cache = SpectrumProcessor.result_cache
+        if cache is not None:
+            files = list(files)
+            input_hash = [(get_name(path), cache.file_hash(path)) for path in files]
+            key = cache.make_key("sum_spectra", input_hash, {"name_modifier": name_modifier})
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
 
         result = GammaSpectrum()
-        for i, spectrum in enumerate(spectra):
-            if i == 0:
-                result.header = spectrum.header
-                result.footer = spectrum.footer
-                result.detector = spectrum.detector
-                name_prefix = get_file_number(spectrum.name)
-                result.counts = spectrum.counts
-                result.times = spectrum.times
-            else:
-                result.counts = np.add(np.array(result.counts), np.array(spectrum.counts))
-                result.times = np.add(np.array(result.times), np.array(spectrum.times))
-
-            if i == len(spectra) - 1:
-                result.update_times(result.times)
-                name_suffix = get_file_number(spectrum.name)
-                result.name = f"SumSpectra{result.detector.name}{name_modifier}-{name_prefix}_to_{name_suffix}"
-                result.file_extension = ".Spe"
-        result.times = result.times.tolist()
+        first_path = last_path = None
+        for path in files:
+            spe = spe_reader.read_spe(path)
+            if first_path is None:
+                first_path = path
+                result.header = spe.header
+                result.footer = spe.footer
+                result.counts = np.zeros(len(spe.counts), dtype=GammaSpectrum.SUM_DTYPE)
+                result.times = np.zeros_like(spe.times)
+            np.add(result.counts, spe.counts, out=result.counts)
+            result.times += spe.times
+            last_path = path
+
+        if first_path is None:
+            raise ValueError("No spectra to sum")
+
+        result.detector = Detector(misc.get_detector_from_filename(first_path))
+        result.update_times(result.times)
+        result.name = get_sum_name(result.detector, name_modifier, get_name(first_path), get_name(last_path))
+        result.file_extension = ".Spe"
+        result.length = len(result.counts)
         result.fill_channels()
         result.fill_energies()
+        if cache is not None:
+            cache.put(key, result)
         return result
 
     @staticmethod
-    def get_normalized_background(detector_type: DetectorType, spectrum_time: int | float) -> GammaSpectrum:
+    def get_normalized_background(detector_type: DetectorType, spectrum_time: int | float,
+                                  replace_zeros=False) -> GammaSpectrum:
         """
         Normalizes the background for a given detector type to the given measurement time.
+        :param replace_zeros: Replace zero background counts by the smallest nonzero count
         """
         detector = Detector(detector_type)
-        background_spectrum = GammaSpectrum().load(detector.bg_path)
-        scaling_factor = spectrum_time / detector.bg_times[0]
-
-        background_spectrum.counts = list(map(lambda c: c * scaling_factor, background_spectrum.counts))
+        cache = SpectrumProcessor.background_cache
+        background_spectrum = cache.get_background(detector)[0].copy()
+        background_spectrum.counts = cache.get_scaled(detector, spectrum_time, replace_zeros=replace_zeros)
         return background_spectrum
 
     @staticmethod
+    @profiled
+    def subtract_background_stack(counts: np.ndarray, live_times, detector: Detector, significance=0) -> np.ndarray:
+        """
+        Subtracts the detector background from a stack of spectra in one array expression
+        :param counts: (n_spectra x channels) matrix of counts
+        :param live_times: Live time of each spectrum (row), used to scale the background
+        :param detector: The detector of all spectra in the stack
+        :param significance: How to treat low numbers. If significance == 0, all counts below 0 are dropped,
+        otherwise counts below the scaled background + its standard deviation are dropped
+        :return: (n_spectra x channels) float64 matrix of background subtracted counts
+        """
+        counts = np.atleast_2d(counts)
+        # Spectra of a shot mostly share their live time: each scaled background is taken from the cache
+        unique_times, inverse = np.unique(np.asarray(live_times), return_inverse=True)
+        bg_scaled = np.stack([SpectrumProcessor.background_cache.get_scaled(detector, live_time,
+                                                                            replace_zeros=bool(significance))
+                              for live_time in unique_times.tolist()])[inverse.reshape(-1)]
+        result = counts - bg_scaled
+        if significance:
+            threshold = np.sqrt(bg_scaled)
+            threshold += bg_scaled
+        else:
+            threshold = 0
+        result[result <= threshold] = 0.0
+        return result
+
+    @staticmethod
+    @profiled
     def subtract_background(spectrum: GammaSpectrum, significance=0) -> GammaSpectrum:
         """
         Subtracts background from a GammaSpectrum based on the detector type
@@ -241,28 +748,101 @@ class SpectrumProcessor:
         :param spectrum: A GammaSpectrum to subtract the background from
         :return: The GammaSpectrum with subtracted background
         """
+        return SpectrumProcessor.subtract_background_multiple([spectrum], significance=significance)[0]
 
-        detector = spectrum.detector
-        background_spectrum = GammaSpectrum().load(detector.bg_path)
+    @staticmethod
+    @profiled
+    def subtract_background_multiple(spectra: list[GammaSpectrum], significance=0) -> list[GammaSpectrum]:
+        """
+        Subtracts background from multiple spectra. Spectra of the same detector and length are stacked
+        and processed by subtract_background_stack at once. With the result cache enabled,
+        only spectra without a cached result are processed
+        :param spectra: GammaSpectra to subtract the background from
+        :param significance: See subtract_background
+        :return: The GammaSpectra with subtracted background, in the input order
+        """
+        cache = SpectrumProcessor.result_cache
+        results = [None] * len(spectra)
+        keys = [None] * len(spectra)
+        if cache is not None:
+            detector_hashes = {}
+            for i, spectrum in enumerate(spectra):
+                if spectrum.detector.type not in detector_hashes:
+                    detector_hashes[spectrum.detector.type] = cache.detector_hash(spectrum.detector,
+                                                                                  include_background=True)
+                keys[i] = cache.make_key("subtract_background", cache.spectrum_hash(spectrum),
+                                         {"significance": significance}, detector_hashes[spectrum.detector.type])
+                results[i] = cache.get(keys[i])
+
+        groups = {}
+        for i, spectrum in enumerate(spectra):
+            if results[i] is None:
+                groups.setdefault((spectrum.detector.type, len(spectrum.counts)), []).append(i)
+
+        for indices in groups.values():
+            group = [spectra[i] for i in indices]
+            counts = SpectrumProcessor.subtract_background_stack(np.stack([sp.counts for sp in group]),
+                                                                 [sp.times[0] for sp in group],
+                                                                 group[0].detector, significance=significance)
+            for i, spectrum, row in zip(indices, group, counts):
+                results[i] = SpectrumProcessor._background_subtracted(spectrum, row, significance)
+                if cache is not None:
+                    cache.put(keys[i], results[i])
+        return results
 
+    @staticmethod
+    @profiled
+    def filter_multiple(spectra: list[GammaSpectrum], method="gauss", **params) -> (np.ndarray, np.ndarray):
+        """
+        Filters spectra in place. Spectra of the same length and dtype are stacked and filtered
+        in one array operation. With the result cache enabled, only spectra without a cached result are filtered
+        :param spectra: The spectra to filter
+        :param method: "gauss", "savgol" or "snip", see filters.py
+        :param params: Parameters of the filter, e.g. sigma=1 for "gauss"
+        :return: The noise levels of the spectra before and after filtering, shape (n_spectra,)
+        """
+        if method == "gauss":
+            params.setdefault("sigma", 1)
+        cache = SpectrumProcessor.result_cache
+        filtered = [None] * len(spectra)
+        keys = [None] * len(spectra)
+        if cache is not None:
+            for i, spectrum in enumerate(spectra):
+                keys[i] = cache.make_key("filter", cache.spectrum_hash(spectrum), {"method": method, **params})
+                filtered[i] = cache.get(keys[i])
+
+        groups = {}
+        for i, spectrum in enumerate(spectra):
+            groups.setdefault((len(spectrum.counts), spectrum.counts.dtype.str), []).append(i)
+
+        initial_noise = np.empty(len(spectra))
+        resulting_noise = np.empty(len(spectra))
+        for indices in groups.values():
+            counts = np.stack([spectra[i].counts for i in indices])
+            missing = [row for row, i in enumerate(indices) if filtered[i] is None]
+            if missing:
+                stack = filters.apply_filter(counts[missing], method=method, **params)
+                for row, filtered_row in zip(missing, stack):
+                    filtered[indices[row]] = filtered_row
+                    if cache is not None:
+                        cache.put(keys[indices[row]], filtered_row)
+            initial_noise[indices] = filters.estimate_noise(counts)
+            resulting_noise[indices] = filters.estimate_noise(np.stack([filtered[i] for i in indices]))
+
+        suffix = "_filtered" if method == "gauss" else f"_{method}_filtered"
+        for spectrum, filtered_counts in zip(spectra, filtered):
+            spectrum.counts = filtered_counts
+            spectrum.name += suffix
+        return initial_noise, resulting_noise
+
+    @staticmethod
+    def _background_subtracted(spectrum: GammaSpectrum, counts: np.ndarray, significance) -> GammaSpectrum:
         result = GammaSpectrum()
-        result.detector = detector
+        result.detector = spectrum.detector
         result.channels = spectrum.channels
-
-        scaling_factor = spectrum.times[0] / detector.bg_times[0]
-
-        if significance:
-            min_nonzero_bg = min(bg for bg in background_spectrum.counts if bg > 0)
-            result.counts = []
-            for bg, cnt in zip(background_spectrum.counts, spectrum.counts):
-                bg_scaled = bg * scaling_factor if bg > 0 else min_nonzero_bg * scaling_factor
-                threshold = np.sqrt(bg_scaled) + bg_scaled
-                cnt_new = cnt - bg_scaled
-                result.counts.append(cnt_new) if cnt_new > threshold else result.counts.append(0)
-        else:
-            result.counts = [spec - bg * scaling_factor if spec - bg * scaling_factor > 0 else 0 for spec, bg
-                             in zip(spectrum.counts, background_spectrum.counts)]
-
+        result.counts = counts
+        result.zeros_dropped = True
+        result.length = len(result.counts)
         result.fill_energies()
         result.name = f"{spectrum.name}_NO_BG"
         if significance:
@@ -0,0 +1,298 @@
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+"""
+Per-stage instrumentation.
+Functions decorated with @profiled and code run in `with stage(name):` record their wall time, number of calls,
+bytes read and written and (optionally) peak memory. Nested stages are recorded per call stack,
+so the report shows both the totals of every stage and where its time was spent.
+Recording is off by default: a disabled profiled function costs one flag check per call.
+
+    instrumentation.enable(trace_memory=True)
+    ...
+    instrumentation.print_report()
+    instrumentation.save_report("profile.json")
+    instrumentation.save_flamegraph("profile.folded")
+"""
+
+ENABLED = False
+
+_trace_memory = False
+_stats = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class StageStats:
+    """
+    Totals of one call stack. seconds, bytes and peak_memory include the nested stages,
+    self_seconds is the time spent outside of them
+    """
+    __slots__ = ("calls", "seconds", "self_seconds", "bytes_read", "bytes_written", "peak_memory")
+
+    def __init__(self, calls=0, seconds=0.0, self_seconds=0.0, bytes_read=0, bytes_written=0, peak_memory=0):
+        self.calls = calls
+        self.seconds = seconds
+        self.self_seconds = self_seconds
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+        self.peak_memory = peak_memory
+
+    def add(self, other: "StageStats") -> None:
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.self_seconds += other.self_seconds
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.peak_memory = max(self.peak_memory, other.peak_memory)
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _Frame:
+    __slots__ = ("stack", "start", "child_seconds", "bytes_read", "bytes_written", "start_memory", "peak_memory")
+
+    def __init__(self, stack: tuple):
+        self.stack = stack
+        self.child_seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.start_memory = 0
+        self.peak_memory = 0
+        self.start = time.perf_counter()
+
+
+def _get_frames() -> list:
+    frames = getattr(_local, "frames", None)
+    if frames is None:
+        frames = _local.frames = []
+    return frames
+
+
+class _Stage:
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        frames = _get_frames()
+        parent = frames[-1] if frames else None
+        frame = _Frame(parent.stack + (self.name,) if parent else (self.name,))
+        if _trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak is reset for the nested stage, the parent keeps the peak reached so far
+            if parent is not None:
+                parent.peak_memory = max(parent.peak_memory, peak)
+            tracemalloc.reset_peak()
+            frame.start_memory = frame.peak_memory = current
+        frames.append(frame)
+        frame.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        frames = _get_frames()
+        frame = frames.pop()
+        seconds = end - frame.start
+        peak_memory = 0
+        if _trace_memory and tracemalloc.is_tracing():
+            frame.peak_memory = max(frame.peak_memory, tracemalloc.get_traced_memory()[1])
+            peak_memory = frame.peak_memory - frame.start_memory
+        if frames:
+            parent = frames[-1]
+            parent.child_seconds += seconds
+            parent.bytes_read += frame.bytes_read
+            parent.bytes_written += frame.bytes_written
+            parent.peak_memory = max(parent.peak_memory, frame.peak_memory)
+        with _lock:
+            stats = _stats.get(frame.stack)
+            if stats is None:
+                stats = _stats[frame.stack] = StageStats()
+            stats.add(StageStats(1, seconds, seconds - frame.child_seconds, frame.bytes_read, frame.bytes_written,
+                                 peak_memory))
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name: str):
+    """
+    Context manager recording the enclosed code as a stage, a no-op while disabled
+    """
+    return _Stage(name) if ENABLED else _NULL_STAGE
+
+
+def profiled(function):
+    """
+    Decorator recording every call of the function as a stage named by its qualified name,
+    e.g. "SpectrumProcessor.sum_spectra". Put it below @staticmethod
+    """
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return function(*args, **kwargs)
+        with _Stage(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def _add_bytes(attribute: str, size: int) -> None:
+    frames = _get_frames()
+    if frames:
+        setattr(frames[-1], attribute, getattr(frames[-1], attribute) + size)
+    else:
+        with _lock:
+            stats = _stats.get(("(no stage)",))
+            if stats is None:
+                stats = _stats[("(no stage)",)] = StageStats()
+            setattr(stats, attribute, getattr(stats, attribute) + size)
+
+
+def add_bytes_read(size: int) -> None:
+    """
+    Adds bytes read from files to the current stage
+    """
+    if ENABLED:
+        _add_bytes("bytes_read", size)
+
+
+def add_bytes_written(size: int) -> None:
+    """
+    Adds bytes written to files to the current stage
+    """
+    if ENABLED:
+        _add_bytes("bytes_written", size)
+
+
+def enable(trace_memory=False) -> None:
+    """
+    Starts recording
+    :param trace_memory: Also record the peak memory of every stage with tracemalloc.
+    This makes allocations, and with them most of the processing, noticeably slower
+    """
+    global ENABLED, _trace_memory
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    ENABLED = True
+
+
+def disable() -> None:
+    global ENABLED, _trace_memory
+    ENABLED = False
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _trace_memory = False
+
+
+def reset() -> None:
+    """
+    Clears the recorded stages
+    """
+    with _lock:
+        _stats.clear()
+
+
+def get_stats() -> dict:
+    """
+    A copy of the recorded stages: {call stack tuple: StageStats}. Can be sent to another process and merged there
+    """
+    with _lock:
+        return {stack: StageStats(**stats.to_dict()) for stack, stats in _stats.items()}
+
+
+def merge_stats(stats: dict) -> None:
+    """
+    Adds stages recorded elsewhere, e.g. by get_stats in a worker process
+    """
+    with _lock:
+        for stack, other in stats.items():
+            _stats.setdefault(stack, StageStats()).add(other)
+
+
+def get_totals() -> dict:
+    """
+    Totals of every stage over all call stacks it appears in: {stage name: StageStats}
+    """
+    totals = {}
+    for stack, stats in get_stats().items():
+        name = stack[-1]
+        total = totals.setdefault(name, StageStats())
+        if name in stack[:-1]:
+            # Recursive call, its time and bytes are already part of the outer call
+            total.calls += stats.calls
+            total.self_seconds += stats.self_seconds
+        else:
+            total.add(stats)
+    return totals
+
+
+def get_report() -> dict:
+    """
+    :return: {"stages": {stage name: totals}, "stacks": [{"stack": [names], ...totals}]}
+    """
+    totals = get_totals()
+    return {
+        "trace_memory": _trace_memory,
+        "stages": {name: totals[name].to_dict() for name in sorted(totals, key=lambda n: -totals[n].seconds)},
+        "stacks": [{"stack": list(stack), **stats.to_dict()} for stack, stats in get_stats().items()],
+    }
+
+
+def save_report(out_path: str) -> None:
+    with open(out_path, "w") as f:
+        json.dump(get_report(), f, indent=4)
+
+
+def save_flamegraph(out_path: str) -> None:
+    """
+    Writes the stages in the collapsed stack format ("stage;nested stage;... microseconds" per line),
+    read by flamegraph.pl, speedscope and most other flame graph viewers
+    """
+    with open(out_path, "w") as f:
+        for stack, stats in get_stats().items():
+            microseconds = round(stats.self_seconds * 1e6)
+            if microseconds > 0:
+                f.write(f"{';'.join(stack)} {microseconds}\n")
+
+
+def format_bytes(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def print_report() -> None:
+    """
+    Prints the totals of every stage, slowest first. Stages run on other threads (e.g. BatchWriter)
+    are counted on their own and not as part of the stage that started them
+    """
+    totals = get_totals()
+    width = max([len(name) for name in totals] + [5]) + 2
+    print(f"{'stage':<{width}}{'calls':>8}{'total, s':>10}{'self, s':>10}{'read':>11}{'written':>11}"
+          + (f"{'peak memory':>13}" if _trace_memory else ""))
+    print("-" * (width + 50 + (13 if _trace_memory else 0)))
+    for name, stats in sorted(totals.items(), key=lambda item: -item[1].seconds):
+        print(f"{name:<{width}}{stats.calls:>8}{stats.seconds:>10.3f}{stats.self_seconds:>10.3f}"
+              f"{format_bytes(stats.bytes_read):>11}{format_bytes(stats.bytes_written):>11}"
+              + (f"{format_bytes(stats.peak_memory):>13}" if _trace_memory else ""))
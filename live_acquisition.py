@@ -0,0 +1,203 @@
+import argparse
+import os
+import re
+import time
+import numpy as np
+import misc
+import spe_reader
+from detector_manager import Detector
+from fit_decay import get_mid_times
+from gamma_spectrum import GammaSpectrum, SpectrumProcessor, get_sum_name
+from roi import RoiIntegrator, parse_roi_footer
+
+"""
+Live analysis of a running acquisition.
+The MCA writes a new .Spe file into the measurement directory every few minutes. The monitor polls the directory,
+parses only newly completed files and updates the running sum, its background subtracted version
+and the ROI area (decay) series incrementally.
+
+Usage:
+python live_acquisition.py "input_path" --rois 2700-2790 3100-3150 --significance 3 --interval 10
+"input_path": The directory the MCA writes the .Spe files into
+--rois: Channel ROIs to follow (default: the ROIs from the footer of the first file)
+--significance: Significance for the background subtraction of the running sum
+--interval: Polling interval in seconds
+"""
+
+
+class LiveShotMonitor:
+    """
+    Incrementally processes the .Spe files of a measurement directory as they are written
+    """
+
+    def __init__(self, directory: str, rois=None, significance=0, settle_time=2.0):
+        """
+        :param directory: The directory the MCA writes the .Spe files into
+        :param rois: (n_rois x 2) channel ROIs to follow. Default: the ROIs of the first file's footer
+        :param significance: Significance used for the background subtracted running sum
+        :param settle_time: A file is only read once it has not changed for this many seconds
+        """
+        self.directory = directory
+        self.rois = None if rois is None else np.asarray(rois, dtype=np.int64).reshape(-1, 2)
+        self.significance = significance
+        self.settle_time = settle_time
+
+        self.detector = None
+        self.header = None
+        self.footer = None
+        self.names = []
+        self.sum_counts = None
+        self.sum_times = None
+        self.times = []
+        self.gross_areas = []
+        self.net_areas = []
+        self.net_area_errors = []
+        self._processed = set()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def _find_completed(self) -> list[str]:
+        """
+        New .Spe files whose size and mtime did not change since the previous poll and for at least settle_time
+        """
+        now = time.time()
+        completed = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name in self._processed or not misc.check_file_extension(entry.name, ".Spe"):
+                    continue
+                stat = entry.stat()
+                signature = (stat.st_size, stat.st_mtime)
+                if self._pending.get(entry.name) == signature and now - stat.st_mtime >= self.settle_time:
+                    completed.append(entry.name)
+                self._pending[entry.name] = signature
+
+        def sort_key(name):
+            match = re.search(r"(\d+)$", os.path.splitext(name)[0])
+            return int(match.group()) if match else -1
+
+        return sorted(completed, key=sort_key)
+
+    def _add_file(self, filename: str) -> bool:
+        path = os.path.join(self.directory, filename)
+        try:
+            spe = spe_reader.read_spe(path)
+        except (ValueError, IndexError):
+            # Not completely written yet, retried at the next poll
+            self._pending.pop(filename, None)
+            return False
+
+        if self.sum_counts is None:
+            self.detector = Detector(misc.get_detector_from_filename(path))
+            self.header = spe.header
+            self.footer = spe.footer
+            self.sum_counts = np.zeros(len(spe.counts), dtype=GammaSpectrum.SUM_DTYPE)
+            self.sum_times = np.zeros_like(spe.times)
+            if self.rois is None:
+                self.rois = parse_roi_footer(spe.footer)
+        elif len(spe.counts) != len(self.sum_counts):
+            raise ValueError(f"{path}: expected {len(self.sum_counts)} channels, found {len(spe.counts)}")
+
+        np.add(self.sum_counts, spe.counts, out=self.sum_counts)
+        self.sum_times += spe.times
+        self.times.append(spe.times)
+        if len(self.rois):
+            areas = RoiIntegrator(spe.counts).areas(self.rois)
+            self.gross_areas.append(areas.gross[0])
+            self.net_areas.append(areas.net[0])
+            self.net_area_errors.append(areas.net_errors[0])
+
+        self.names.append(os.path.splitext(filename)[0])
+        self._processed.add(filename)
+        self._pending.pop(filename, None)
+        return True
+
+    def poll(self) -> list[str]:
+        """
+        Processes the files completed since the last poll
+        :return: Names of the newly processed files
+        """
+        return [filename for filename in self._find_completed() if self._add_file(filename)]
+
+    def run(self, interval=10.0, callback=None, max_polls=None) -> None:
+        """
+        Polls the directory until interrupted (Ctrl+C) or max_polls is reached
+        :param interval: Seconds between polls
+        :param callback: Called as callback(monitor, new_files) after every poll with new files
+        :param max_polls: Stop after this many polls
+        """
+        polls = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                new_files = self.poll()
+                if new_files and callback is not None:
+                    callback(self, new_files)
+                polls += 1
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+    def sum_spectrum(self, name_modifier="") -> GammaSpectrum:
+        """
+        The running sum of all processed files, like SpectrumProcessor.sum_spectra
+        """
+        if self.sum_counts is None:
+            raise ValueError("No files processed yet")
+        result = GammaSpectrum()
+        result.header = self.header
+        result.footer = self.footer
+        result.detector = self.detector
+        result.counts = self.sum_counts.copy()
+        result.times = self.sum_times.copy()
+        result.update_times(result.times)
+        result.name = get_sum_name(self.detector, name_modifier, self.names[0], self.names[-1])
+        result.file_extension = ".Spe"
+        result.length = len(result.counts)
+        result.fill_channels()
+        result.fill_energies()
+        return result
+
+    def background_subtracted(self) -> np.ndarray:
+        """
+        The running sum with the background subtracted, O(channels) per call
+        """
+        return SpectrumProcessor.subtract_background_stack(self.sum_counts, [self.sum_times[0]], self.detector,
+                                                           significance=self.significance)[0]
+
+    def decay_series(self) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        ROI net area series of the processed files
+        :return: measurement mid-times (n_files,), net areas and their errors (n_files x n_rois)
+        """
+        n_rois = 0 if self.rois is None else len(self.rois)
+        if not self.times:
+            return np.empty(0), np.empty((0, n_rois)), np.empty((0, n_rois))
+        mid_times = get_mid_times(np.stack(self.times))
+        if n_rois == 0:
+            # No ROIs to follow: no areas are recorded
+            return mid_times, np.empty((len(self.times), 0)), np.empty((len(self.times), 0))
+        return mid_times, np.stack(self.net_areas), np.stack(self.net_area_errors)
+
+
+def print_update(monitor: LiveShotMonitor, new_files: list[str]) -> None:
+    mid_times, net_areas, net_errors = monitor.decay_series()
+    print(f"{len(monitor)} files, live time {monitor.sum_times[0]} s, new: {', '.join(new_files)}")
+    if not net_areas.size:
+        return
+    for (start, end), area, error in zip(monitor.rois, net_areas[-1], net_errors[-1]):
+        print(f"    ROI {start}-{end}: net area {area:.1f} ± {error:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", type=str, help="The directory the MCA writes the .Spe files into")
+    parser.add_argument("--rois", nargs="*", help="Channel ROIs as start-end")
+    parser.add_argument("--significance", type=int, default=0, help="Background subtraction significance")
+    parser.add_argument("--interval", type=float, default=10, help="Polling interval in seconds")
+    args = parser.parse_args()
+
+    roi_list = [list(map(int, roi.split("-"))) for roi in args.rois] if args.rois else None
+    LiveShotMonitor(args.input_path, rois=roi_list, significance=args.significance).run(
+        interval=args.interval, callback=print_update)
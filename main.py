@@ -1,14 +1,31 @@
+import time
+
+# Import time of the program, reported at startup. Per-module details: python -X importtime main.py
+import_start = time.perf_counter()
+
 from gamma_spectrum import GammaSpectrum, SpectrumProcessor
-from misc import get_filenames, check_file_extension
+from misc import check_file_extension
+from directory_index import get_index
 import os
 import config
 from plotter import Plotter
+from export import BatchWriter
+from sparse_spectrum import SparseSpectrum
+import instrumentation
 import re
 
+import_time = time.perf_counter() - import_start
+
 """
 (!) Edit the config.py file to use correct file paths
 """
 
+# True: write compact .json files, much faster to write. False: the indented format of older versions
+COMPACT_OUTPUT = False
+# Path of a .json profile of the run (time, calls, bytes and peak memory per stage), written on quit.
+# A .folded flame graph is written next to it. None: no profiling
+PROFILE_OUTPUT = None
+
 
 def get_files(message: str, path='') -> list:
     ATTEMPTS = 3
@@ -20,7 +37,7 @@ def get_files(message: str, path='') -> list:
         else:
             input_path = path
         if os.path.isdir(input_path):
-            files = get_filenames(input_path, *config.SUPPORTED_FILE_EXTENSIONS)
+            files = get_index(input_path).paths()
             if files:
                 return files
             else:
@@ -57,15 +74,16 @@ def sum_spectra(input_spectra: list[GammaSpectrum]) -> list[GammaSpectrum]:
                              f"---> ").strip()
 
         i_start = int(prompt_start) if prompt_start.isdigit() else 0
+        i_end = -1
 
         if prompt_start != "a":
-            prompt_end = input(f"[a] - sum all files ({valid_spectra[i_start].name} to {valid_spectra[-1].name})\n"
+            prompt_end = input(f"[a] - sum all files (from {i_start} to {valid_spectra[-1].name})\n"
                                f"['number'] sum files UNTIL 'number'\n"
                                f"---> ").strip()
 
             i_end = int(prompt_end) if prompt_end.isdigit() else -1
 
-        result = processor.sum_spectra(spectra, name_modifier=shot_name, start=i_start, end=i_end)
+        result = processor.sum_spectra(valid_spectra, name_modifier=shot_name, start=i_start, end=i_end)
         out_path = config.save_paths["sums"][result.detector.type]
 
         print(f"[y] - Save {result.name} to default directory\n"
@@ -84,6 +102,25 @@ def sum_spectra(input_spectra: list[GammaSpectrum]) -> list[GammaSpectrum]:
         print(f"No .Spe files found to sum.")
 
 
+def save_spectrum(writer: BatchWriter, sp: GammaSpectrum, out_directory: str, out_format: str,
+                  output_energies=False, filename_suffix="") -> None:
+    if out_format == "json":
+        writer.save_json(sp, out_directory, filename_suffix=filename_suffix)
+    elif out_format in ["raw", "csv"]:
+        writer.save_raw(sp, out_directory, output_energies=output_energies, filename_suffix=filename_suffix)
+    elif out_format == "npz":
+        writer.save_npz(sp, out_directory, filename_suffix=filename_suffix)
+    elif out_format in ["sparse", "sparse_npz"]:
+        writer.save_sparse(SparseSpectrum.from_spectrum(sp), out_directory, binary=out_format == "sparse_npz",
+                           filename_suffix=filename_suffix)
+    else:
+        raise ValueError(f"Unsupported output format: {out_format}")
+
+
+def get_writer() -> BatchWriter:
+    return BatchWriter(compact_json=COMPACT_OUTPUT, cache=processor.result_cache)
+
+
 def subtract_background(input_spectra: list[GammaSpectrum], out_format="json") -> list[GammaSpectrum]:
     if input_spectra:
         processed_spectra = []
@@ -92,14 +129,11 @@ def subtract_background(input_spectra: list[GammaSpectrum], out_format="json") -
                                         "(0 = preserve all nonzero counts): \n"
                                         "---> ").strip())
 
-        for sp in input_spectra:
-            result = processor.subtract_background(spectrum=sp, significance=significance_prompt)
-            out_directory = config.save_paths["processed"][result.detector.type]["bg_subtracted"]
-            if out_format == "json":
-                result.save_json(out_directory)
-            elif out_format in ["raw", "csv"]:
-                result.save_raw(out_directory)
-            processed_spectra.append(result)
+        with get_writer() as writer:
+            for result in processor.subtract_background_multiple(input_spectra, significance=significance_prompt):
+                out_directory = config.save_paths["processed"][result.detector.type]["bg_subtracted"]
+                save_spectrum(writer, result, out_directory, out_format)
+                processed_spectra.append(result)
 
         return processed_spectra
 
@@ -108,11 +142,20 @@ def select_output_format() -> str:
     prompt = input("Select the output file format:\n"
                    "[j] = .json\n"
                    "[c] = .csv\n"
+                   "[b] = .npz (binary)\n"
+                   "[s] = sparse .json (nonzero channels only, e.g. after background subtraction)\n"
+                   "[z] = sparse .npz (binary)\n"
                    "---> ").strip().lower()
     if prompt in ["j", "json", ".json"]:
         return "json"
     elif prompt in ["c", "csv", ".csv"]:
         return "csv"
+    elif prompt in ["b", "npz", ".npz"]:
+        return "npz"
+    elif prompt in ["s", "sparse"]:
+        return "sparse"
+    elif prompt in ["z", "sparse_npz"]:
+        return "sparse_npz"
     else:
         raise TypeError("Could not determine the output file format")
 
@@ -126,20 +169,17 @@ def add_energies_remove_headers(input_spectra: list[GammaSpectrum], out_format="
                                  "[n] output channel numbers\n"
                                  "---> ").strip().lower()
 
-        for sp in input_spectra:
-            if use_energy_scale == "y":
-                out_directory = config.save_paths["processed"][sp.detector.type]["energy_scale"]
-                suffix = "_energies"
-            else:
-                out_directory = config.save_paths["processed"][sp.detector.type]["counts"]
-                suffix = "_counts"
-            if out_format == "json":
-                sp.save_json(out_directory=out_directory,
-                             filename_suffix=suffix)
-            elif out_format in ["raw", "csv"]:
-                sp.save_raw(out_directory=out_directory, output_energies=use_energy_scale == "y",
-                            filename_suffix=suffix)
-            processed_spectra.append(sp)
+        with get_writer() as writer:
+            for sp in input_spectra:
+                if use_energy_scale == "y":
+                    out_directory = config.save_paths["processed"][sp.detector.type]["energy_scale"]
+                    suffix = "_energies"
+                else:
+                    out_directory = config.save_paths["processed"][sp.detector.type]["counts"]
+                    suffix = "_counts"
+                save_spectrum(writer, sp, out_directory, out_format, output_energies=use_energy_scale == "y",
+                              filename_suffix=suffix)
+                processed_spectra.append(sp)
 
         return processed_spectra
 
@@ -147,39 +187,47 @@ def add_energies_remove_headers(input_spectra: list[GammaSpectrum], out_format="
 def filter_spectra(input_spectra: list[GammaSpectrum], out_format="json") -> list[GammaSpectrum]:
     if input_spectra:
         processed_spectra = []
+        print("Filtering data...")
+        initial_noise, resulting_noise = processor.filter_multiple(input_spectra)
 
-        for sp in input_spectra:
-            out_directory = config.save_paths["processed"][sp.detector.type]["filtered"]
-            sp.apply_filtering()
-            processed_spectra.append(sp)
-            if out_format == "json":
-                sp.save_json(out_directory=out_directory)
-            elif out_format in ["raw", "csv"]:
-                sp.save_raw(out_directory=out_directory, output_energies=True)
+        with get_writer() as writer:
+            for sp, initial, resulting in zip(input_spectra, initial_noise, resulting_noise):
+                out_directory = config.save_paths["processed"][sp.detector.type]["filtered"]
+                print(f"{sp.name}: noise level {initial:.2f} -> {resulting:.2f}")
+                processed_spectra.append(sp)
+                save_spectrum(writer, sp, out_directory, out_format, output_energies=True)
 
         return processed_spectra
 
 
+def save_profile(out_path: str) -> None:
+    instrumentation.print_report()
+    instrumentation.save_report(out_path)
+    flamegraph_path = os.path.splitext(out_path)[0] + ".folded"
+    instrumentation.save_flamegraph(flamegraph_path)
+    print(f"Profile saved to {out_path} and {flamegraph_path}")
+
+
 def convert_format(input_spectra: list[GammaSpectrum], output_format: str, save_path=config.processed_path):
-    for sp in input_spectra:
-        if output_format == "json":
-            sp.save_json(save_path)
-        elif output_format == "csv":
-            sp.save_raw(save_path, output_energies=sp.energies is not None)
-        print(f"{sp.name} saved")
-    print(f"All files saved in {save_path}")
+    with get_writer() as writer:
+        for sp in input_spectra:
+            save_spectrum(writer, sp, save_path, output_format, output_energies=sp.energies is not None)
 
 
 print(config.logo)
+print(f"Started in {import_time:.2f} s")
+if PROFILE_OUTPUT:
+    instrumentation.enable(trace_memory=True)
 
 processor = SpectrumProcessor()
+processor.enable_result_cache()
 plotter = Plotter()
 
 iteration = 0
 while True:
     if iteration == 0:
         print()
-        spectra = processor.load_multiple_spectra(get_files(message="Path to a spectrum file/directory: "))
+        spectra = processor.load_multiple_spectra(get_files(message="Path to a spectrum file/directory: "), lazy=True)
 
     print(f"\nCurrent files:")
     print("-" * 30)
@@ -224,12 +272,13 @@ while True:
                                   ylim=ylim, scale="energy")
 
         case "n":
-            spectra = processor.load_multiple_spectra(get_files(message="Path to a spectrum file/directory: "))
+            spectra = processor.load_multiple_spectra(get_files(message="Path to a spectrum file/directory: "),
+                                                      lazy=True)
 
         case "a":
             spectra.extend(processor.load_multiple_spectra(get_files(
                 message="Path to an additional spectrum file/directory: "
-            )))
+            ), lazy=True))
 
         case "f":
             out_format = select_output_format()
@@ -246,7 +295,7 @@ while True:
             for direct in dirs:
                 direct = os.path.join(root, direct, "Messungen")
                 try:
-                    spectra = processor.load_multiple_spectra(get_files(message="Path to a spectrum file/directory: "))
+                    spectra = processor.load_multiple_spectra(get_files(message="", path=direct), lazy=True)
                 except FileExistsError:
                     continue
 
@@ -257,7 +306,7 @@ while True:
                         f"{valid_spectra[0].name}{valid_spectra[0].file_extension} "
                         f"to {valid_spectra[-1].name}{valid_spectra[-1].file_extension}")
                     print()
-                    shot = re.match(r"Shot_\d+", valid_spectra[0].name).group(0)
+                    shot = re.search(r"Shot_\d+", valid_spectra[0].name).group(0)
                     detector = spectra[0].detector
 
                     result = processor.sum_spectra(spectra, name_modifier=shot)
@@ -265,6 +314,8 @@ while True:
                     result.save_spe(os.path.join(out_path, result.name + result.file_extension))
                     print(f"{result.name} saved at {out_path}")
         case "q":
+            if PROFILE_OUTPUT:
+                save_profile(PROFILE_OUTPUT)
             break
         case _:
             pass
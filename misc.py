@@ -10,10 +10,26 @@ def get_sigma(count):
     return np.sqrt(count)
 
 
-def get_detector_from_filename(filename: str) -> DetectorType | None:
+# Set to False for batch runs: functions then raise instead of prompting the user
+INTERACTIVE = True
+
+
+def find_detector_in_filename(filename: str) -> DetectorType | None:
+    """
+    The detector type named in the file name, None if it names none. Never prompts
+    """
     for dtype in DetectorType:
         if dtype.value in filename:
             return dtype
+    return None
+
+
+def get_detector_from_filename(filename: str) -> DetectorType | None:
+    dtype = find_detector_in_filename(filename)
+    if dtype is not None:
+        return dtype
+    if not INTERACTIVE:
+        raise ValueError(f"Unable to derive the detector type from {filename}")
     print(f"\nUnable to derive the detector type from {filename}!")
     prompt = input("Specify manually [b/s] ---> ").strip().lower()
     if prompt == "b":
@@ -24,6 +40,22 @@ def get_detector_from_filename(filename: str) -> DetectorType | None:
         raise ValueError("Unknown detector type")
 
 
+def get_spectrum_number(name: str) -> int:
+    """
+    Returns the running number at the end of a spectrum name, e.g. 12 for "Shot_14 012"
+    """
+    return int(re.search(r"(\d{3,})$", name).group())
+
+
+def get_file_sort_key(path: str) -> (int, str):
+    """
+    Sorts files by the running number at the end of their name, files without one first
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    match = re.search(r"(\d+)$", name)
+    return (int(match.group()) if match else -1), name
+
+
 def check_file_extension(path: str, *supported_extensions: str) -> bool:
     return os.path.splitext(os.path.basename(path))[1].lower() in [ext.lower() for ext in supported_extensions]
 
@@ -34,5 +66,5 @@ def get_filenames(directory: str, *extension: str) -> list[str]:
         for file in os.listdir(directory):
             if check_file_extension(file, *extension):
                 files.append(os.path.join(directory, file))
-        return sorted(files, key=lambda x: int(re.search(r"\d+", x).group(0)))
+        return sorted(files, key=get_file_sort_key)
     return os.listdir(directory)
@@ -1,11 +1,13 @@
 import os
 
-import matplotlib.pyplot as plt
-
 from reader import read_counts, get_Spe_files
 from file_processing import write_area_file
-from scipy.optimize import curve_fit
 import numpy as np
+import spe_reader
+from peak_fitting import fit_peaks
+from spectrum_stack import SpectrumStack
+from roi import RoiIntegrator
+from instrumentation import profiled
 
 TIME_STEP = 300  # Time per one measurement file in seconds
 
@@ -25,6 +27,7 @@ def gauss_fit(path, channel_start, channel_end):
 
     # Initial gauss parameters: amplitude, center, fwhm?
     p0 = [max(y), np.mean(x), (channel_end - channel_start) / 4]
+    from scipy.optimize import curve_fit
     try:
         return curve_fit(f=gauss, xdata=x, ydata=y, p0=p0)[0]
     except RuntimeError:
@@ -45,10 +48,11 @@ def get_peak_data(path, channel_start, channel_end) -> (list, list):
     return channels[channel_start:channel_end + 1], counts[channel_start:channel_end + 1]
 
 
+@profiled
 def sum_peaks_rough(path, channel_start, channel_end):
     """
-    Sun counts over the peak for all files in directory
-    :param path:
+    Sum counts over the peak for all files in directory
+    :param path: Directory with .Spe files or a .gstack file
     :param channel_start:
     :param channel_end:
     :return:
@@ -56,11 +60,7 @@ def sum_peaks_rough(path, channel_start, channel_end):
     if channel_start >= channel_end:
         raise ValueError("channel_start should be LESS than channel_end")
 
-    peak_sums = []
-    for f in get_Spe_files(path):
-        file_path = os.path.join(path, f)
-        f_counts = get_peak_data(file_path, channel_start, channel_end)
-        peak_sums.append(sum(f_counts))
+    peak_sums = RoiIntegrator(get_counts_stack(path)).gross(channel_start, channel_end)
 
     print("TIME\tSUM")
     print("-" * 15)
@@ -68,24 +68,32 @@ def sum_peaks_rough(path, channel_start, channel_end):
         print(f"{TIME_STEP * (i + 1)} \t{s}")
 
 
+def get_counts_stack(path) -> np.ndarray:
+    """
+    Returns the (n_files x channels) counts of all .Spe files in a directory, or the counts of a .gstack file
+    """
+    if path.endswith(SpectrumStack.EXTENSION):
+        return SpectrumStack.open(path).counts
+    return np.stack([spe_reader.read_spe(os.path.join(path, f)).counts for f in get_Spe_files(path)])
+
+
+@profiled
 def get_gauss_areas(path, channel_start, channel_end) -> (list, list):
-    areas = []
-    times = []
-    for i, f in enumerate(get_Spe_files(path)):
-        file_path = os.path.join(path, f)
-        a, x0, sigma = gauss_fit(file_path, channel_start, channel_end)
-        if a and x0 and sigma:
-            area = a * sigma * np.sqrt(np.pi)
-        else:
-            area = None
-        if area:
-            areas.append(area)
-            times.append((i + 1) * TIME_STEP)
-
-    return times, areas
+    """
+    Fits the peak in all spectra at once (see peak_fitting.fit_peaks)
+    :param path: Directory with .Spe files or a .gstack file
+    :return: times and areas of the successfully fitted spectra
+    """
+    fit = fit_peaks(get_counts_stack(path), channel_start, channel_end)
+    times = (np.arange(len(fit.areas)) + 1) * TIME_STEP
+    for i in np.flatnonzero(~fit.success):
+        print(f"Unable to fit spectrum {i + 1}\nSkipping to next")
+    return times[fit.success].tolist(), fit.areas[fit.success].tolist()
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
     CHANNEL_START = 2700
     CHANNEL_END = 2790
     OUTPUT_DIRECTORY = "D:\Anton\Desktop (D)\Shots_processing\AREAS_FITTED"
@@ -0,0 +1,197 @@
+import numpy as np
+from instrumentation import profiled
+
+"""
+Batched Gaussian peak fitting.
+All spectra of a stack are fitted together with a Gauss + linear background model:
+    f(x) = a * exp(-((x - x0) / sigma) ** 2) + b0 + b1 * (x - x_center)
+using a vectorized Levenberg-Marquardt iteration with analytic Jacobians and Poisson weights.
+"""
+
+N_PARAMS = 5  # a, x0, sigma, b0, b1
+
+
+class PeakFitResult:
+    """
+    Results of a batch peak fit, one row per spectrum.
+    Failed fits have success == False and NaN parameters and areas.
+    """
+    __slots__ = ("params", "covariance", "areas", "area_errors", "chi2_reduced", "success", "channel_start",
+                 "channel_end")
+
+    def __init__(self, params, covariance, areas, area_errors, chi2_reduced, success, channel_start, channel_end):
+        self.params = params
+        self.covariance = covariance
+        self.areas = areas
+        self.area_errors = area_errors
+        self.chi2_reduced = chi2_reduced
+        self.success = success
+        self.channel_start = channel_start
+        self.channel_end = channel_end
+
+    @property
+    def amplitudes(self) -> np.ndarray:
+        return self.params[:, 0]
+
+    @property
+    def centers(self) -> np.ndarray:
+        return self.params[:, 1]
+
+    @property
+    def sigmas(self) -> np.ndarray:
+        return self.params[:, 2]
+
+
+def model(x: np.ndarray, params: np.ndarray, x_center: float) -> np.ndarray:
+    """
+    Evaluates the Gauss + linear background model for every row of params
+    :param x: Channels, shape (m,)
+    :param params: (n x 5) parameters
+    :param x_center: Reference channel of the linear background
+    :return: (n x m) model values
+    """
+    a, x0, sigma, b0, b1 = (params[:, i, np.newaxis] for i in range(N_PARAMS))
+    return a * np.exp(-((x - x0) / sigma) ** 2) + b0 + b1 * (x - x_center)
+
+
+def jacobian(x: np.ndarray, params: np.ndarray, x_center: float) -> np.ndarray:
+    """
+    Analytic Jacobian of the model
+    :return: (n x m x 5) derivatives by a, x0, sigma, b0, b1
+    """
+    a, x0, sigma = (params[:, i, np.newaxis] for i in range(3))
+    u = (x - x0) / sigma
+    g = np.exp(-u ** 2)
+    jac = np.empty(g.shape + (N_PARAMS,))
+    jac[..., 0] = g
+    jac[..., 1] = 2 * a * g * u / sigma
+    jac[..., 2] = 2 * a * g * u ** 2 / sigma
+    jac[..., 3] = 1
+    jac[..., 4] = x - x_center
+    return jac
+
+
+def initial_guess(x: np.ndarray, y: np.ndarray, x_center: float) -> np.ndarray:
+    """
+    Moment-based starting parameters: a linear background through the window edges,
+    amplitude, centroid and width of the counts above it
+    """
+    edge = max(1, len(x) // 10)
+    left, right = y[:, :edge].mean(axis=1), y[:, -edge:].mean(axis=1)
+    x_left, x_right = x[:edge].mean(), x[-edge:].mean()
+    b1 = (right - left) / (x_right - x_left)
+    b0 = left + b1 * (x_center - x_left)
+
+    net = np.clip(y - (b0[:, np.newaxis] + b1[:, np.newaxis] * (x - x_center)), 0, None)
+    total = net.sum(axis=1)
+    safe_total = np.where(total > 0, total, 1)
+    x0 = np.where(total > 0, (net * x).sum(axis=1) / safe_total, x_center)
+    variance = (net * (x - x0[:, np.newaxis]) ** 2).sum(axis=1) / safe_total
+    sigma = np.sqrt(2 * variance)
+    sigma = np.where((sigma > 0.5) & (total > 0), sigma, (x[-1] - x[0]) / 8)
+    a = np.maximum(net.max(axis=1), 1)
+    return np.column_stack([a, x0, sigma, b0, b1])
+
+
+def levenberg_marquardt(x: np.ndarray, y: np.ndarray, weights: np.ndarray, params: np.ndarray, x_center: float,
+                        max_iter=100, tol=1e-8) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Runs Levenberg-Marquardt iterations on all rows at once
+    :return: params, chi2 and a convergence flag per row
+    """
+    params = params.copy()
+    damping = np.full(len(params), 1e-3)
+    chi2 = (weights * (y - model(x, params, x_center)) ** 2).sum(axis=1)
+    converged = np.zeros(len(params), dtype=bool)
+    identity = np.eye(N_PARAMS)
+
+    for _ in range(max_iter):
+        active = ~converged
+        if not active.any():
+            break
+        p, w, yy = params[active], weights[active], y[active]
+        jac = jacobian(x, p, x_center)
+        residuals = yy - model(x, p, x_center)
+        jtwj = np.einsum("nmi,nm,nmj->nij", jac, w, jac)
+        jtwr = np.einsum("nmi,nm->ni", jac, w * residuals)
+        damped = jtwj + damping[active, np.newaxis, np.newaxis] * jtwj * identity
+        try:
+            step = np.linalg.solve(damped, jtwr[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            step = (np.linalg.pinv(damped) @ jtwr[..., np.newaxis])[..., 0]
+
+        trial = p + step
+        trial[:, 2] = np.abs(trial[:, 2])
+        trial_chi2 = (w * (yy - model(x, trial, x_center)) ** 2).sum(axis=1)
+        improved = np.isfinite(trial_chi2) & (trial_chi2 <= chi2[active])
+
+        indices = np.flatnonzero(active)
+        relative_change = np.abs(chi2[active] - trial_chi2) / np.maximum(chi2[active], 1e-300)
+        params[indices[improved]] = trial[improved]
+        converged[indices[improved & (relative_change < tol)]] = True
+        chi2[indices[improved]] = trial_chi2[improved]
+        damping[indices] = np.where(improved, damping[indices] / 10, damping[indices] * 10)
+        # A row whose damping has exploded can not be improved any further
+        converged[indices[damping[indices] > 1e10]] = True
+
+    return params, chi2, converged
+
+
+@profiled
+def fit_peaks(counts: np.ndarray, channel_start: int, channel_end: int, max_iter=100,
+              warm_start=True) -> PeakFitResult:
+    """
+    Fits one Gaussian peak on a linear background in the same channel window of every spectrum of a stack
+    :param counts: (n_spectra x channels) counts, e.g. SpectrumStack.counts
+    :param channel_start: First channel of the peak window
+    :param channel_end: Last channel of the peak window (inclusive)
+    :param max_iter: Maximum number of Levenberg-Marquardt iterations
+    :param warm_start: Refit spectra whose fit failed starting from the nearest successful neighbour's solution
+    :return: PeakFitResult with areas and their uncertainties as arrays
+    """
+    if channel_start >= channel_end:
+        raise ValueError("channel_start should be LESS than channel_end")
+
+    x = np.arange(channel_start, channel_end + 1, dtype=np.float64)
+    y = np.atleast_2d(counts)[:, channel_start:channel_end + 1].astype(np.float64)
+    x_center = (channel_start + channel_end) / 2
+    weights = 1 / np.maximum(y, 1)
+
+    def is_valid(p):
+        return (np.isfinite(p).all(axis=1) & (p[:, 0] > 0) & (p[:, 2] > 0) &
+                (p[:, 1] >= channel_start) & (p[:, 1] <= channel_end))
+
+    params, chi2, _ = levenberg_marquardt(x, y, weights, initial_guess(x, y, x_center), x_center, max_iter)
+    success = is_valid(params)
+
+    if warm_start and success.any() and not success.all():
+        good = np.flatnonzero(success)
+        failed = np.flatnonzero(~success)
+        nearest = good[np.abs(failed[:, np.newaxis] - good).argmin(axis=1)]
+        start = params[nearest].copy()
+        start[:, 0] = np.maximum(y[failed].max(axis=1) - start[:, 3], 1)
+        retry, retry_chi2, _ = levenberg_marquardt(x, y[failed], weights[failed], start, x_center, max_iter)
+        params[failed], chi2[failed] = retry, retry_chi2
+        success[failed] = is_valid(retry)
+
+    degrees_of_freedom = max(len(x) - N_PARAMS, 1)
+    chi2_reduced = chi2 / degrees_of_freedom
+    jac = jacobian(x, params, x_center)
+    jtwj = np.einsum("nmi,nm,nmj->nij", jac, weights, jac)
+    covariance = np.full_like(jtwj, np.nan)
+    invertible = success & (np.abs(np.linalg.det(jtwj)) > 0)
+    covariance[invertible] = np.linalg.inv(jtwj[invertible]) * chi2_reduced[invertible, np.newaxis, np.newaxis]
+
+    a, sigma = params[:, 0], params[:, 2]
+    areas = a * sigma * np.sqrt(np.pi)
+    gradient = np.zeros_like(params)
+    gradient[:, 0] = sigma * np.sqrt(np.pi)
+    gradient[:, 2] = a * np.sqrt(np.pi)
+    area_errors = np.sqrt(np.einsum("ni,nij,nj->n", gradient, covariance, gradient))
+
+    params[~success] = np.nan
+    areas[~success] = np.nan
+    area_errors[~success] = np.nan
+    return PeakFitResult(params=params, covariance=covariance, areas=areas, area_errors=area_errors,
+                         chi2_reduced=chi2_reduced, success=success, channel_start=channel_start,
+                         channel_end=channel_end)
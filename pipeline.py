@@ -0,0 +1,259 @@
+import argparse
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import config
+import filters
+import instrumentation
+import misc
+from directory_index import get_index
+from export import BatchWriter
+from gamma_spectrum import GammaSpectrum, SpectrumProcessor
+from sparse_spectrum import SparseSpectrum
+
+"""
+Non-interactive batch processing of whole shot archives.
+Every shot directory below the root is processed in its own worker process, without prompts,
+by a list of stages applied in order. A per-stage timing summary is printed at the end.
+
+Usage:
+python pipeline.py "shot_root" --stages sum subtract_background:3 filter save:spe save:json --output "output_path"
+"shot_root": Directory searched (recursively) for directories containing spectrum files, one per shot
+--stages: Processing stages, applied in the given order:
+    sum                         sum all .Spe files of the shot (streamed, one file in memory at a time),
+                                only allowed as the first stage: it reads the raw files
+    subtract_background[:N]     subtract the detector background with N-sigma significance (default 0)
+    filter[:METHOD]             apply signal filtering, METHOD = gauss (default), savgol or snip (continuum removal)
+    save:FORMAT                 save the current spectra as FORMAT = spe, json, csv, npz (binary),
+                                sparse or sparse_npz (nonzero channels only, e.g. after subtract_background:N,
+                                saved as "{name}_sparse")
+--output "output_path": Root directory for saved files, one subdirectory per shot directory at its path relative
+    to "shot_root" (default: config.processed_path). Skipped when searching for shot directories
+--workers: Number of worker processes (default: number of CPUs)
+--cache "cache_path": Result cache directory (default: ".cache" in the output directory).
+    Unchanged shots and stages are then taken from the cache instead of being recomputed and rewritten
+--no-cache: Disable the result cache
+--compact: Write compact .json files (faster) instead of the indented format of older versions
+--profile "profile_path": Write a .json profile of all workers (time, calls and bytes per stage)
+    and a .folded flame graph next to it
+"""
+
+STAGES = ("sum", "subtract_background", "filter", "save")
+SAVE_FORMATS = ("spe", "json", "csv", "npz", "sparse", "sparse_npz")
+
+
+def parse_stage(stage: str) -> (str, str | None):
+    """
+    Splits "name:argument" and validates the stage
+    """
+    name, _, argument = stage.partition(":")
+    if name not in STAGES:
+        raise ValueError(f"Unknown stage '{name}', expected one of {', '.join(STAGES)}")
+    if name == "save" and argument not in SAVE_FORMATS:
+        raise ValueError(f"Unknown save format '{argument}', expected one of {', '.join(SAVE_FORMATS)}")
+    if name == "filter" and argument and argument not in filters.FILTERS:
+        raise ValueError(f"Unknown filter '{argument}', expected one of {', '.join(filters.FILTERS)}")
+    if name == "subtract_background" and argument and not argument.isdigit():
+        raise ValueError(f"Significance should be an integer, got '{argument}'")
+    return name, argument or None
+
+
+def find_shot_directories(root: str, exclude=None) -> list[str]:
+    """
+    Returns all directories below root (including root) that contain supported spectrum files
+    :param exclude: A directory not searched, e.g. the output directory
+    """
+    excluded = os.path.realpath(exclude) if exclude else None
+    shot_directories = []
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories[:] = [d for d in subdirectories if os.path.realpath(os.path.join(directory, d)) != excluded]
+        if any(misc.check_file_extension(f, *config.SUPPORTED_FILE_EXTENSIONS) for f in files):
+            shot_directories.append(directory)
+    return sorted(shot_directories)
+
+
+def get_shot_name(directory: str) -> str:
+    match = re.search(r"Shot_\d+", directory)
+    return match.group() if match else os.path.basename(os.path.normpath(directory))
+
+
+def get_spectrum_files(directory: str) -> list[str]:
+    """
+    Supported spectrum files of the directory, in the order of their running numbers
+    """
+    return get_index(directory).paths()
+
+
+def save_spectra(spectra: list[GammaSpectrum], out_format: str, out_directory: str, compact_json=False) -> None:
+    with BatchWriter(compact_json=compact_json, cache=SpectrumProcessor.result_cache) as writer:
+        for sp in spectra:
+            if out_format == "spe":
+                if sp.header is None:
+                    raise ValueError(f"{sp.name} has no .Spe header and can not be saved as .Spe")
+                writer.save_spe(sp, os.path.join(out_directory, sp.name + ".Spe"))
+            elif out_format == "json":
+                writer.save_json(sp, out_directory)
+            elif out_format == "npz":
+                writer.save_npz(sp, out_directory)
+            elif out_format in ("sparse", "sparse_npz"):
+                writer.save_sparse(SparseSpectrum.from_spectrum(sp), out_directory, binary=out_format == "sparse_npz")
+            else:
+                writer.save_raw(sp, out_directory, output_energies=sp.energies is not None)
+
+
+def get_out_directory(directory: str, shot_root: str, output_root: str) -> str:
+    """
+    The output directory of a shot directory: its path relative to shot_root, below output_root.
+    Unique for every shot directory, unlike the shot name (e.g. BigDet_Shot_14 and SmallDet_Shot_14)
+    """
+    return os.path.normpath(os.path.join(output_root, os.path.relpath(directory, shot_root)))
+
+
+def parse_stages(stages: list[str]) -> list[tuple]:
+    """
+    Parses and validates the stages, see parse_stage. "sum" reads the raw files,
+    so it would discard the results of any stage before it
+    """
+    parsed_stages = [parse_stage(stage) for stage in stages]
+    if any(name == "sum" for name, _ in parsed_stages[1:]):
+        raise ValueError("'sum' reads the raw .Spe files and can only be the first stage")
+    return parsed_stages
+
+
+def process_shot(directory: str, stages: list[tuple], output_root: str, shot_root: str,
+                 compact_json=False) -> (str, dict, str | None, dict | None):
+    """
+    Runs the stages on one shot directory
+    :param directory: The shot directory
+    :param stages: Parsed stages, see parse_stage
+    :param output_root: Root directory for saved files
+    :param shot_root: Directory the shot directories were found in, see get_out_directory
+    :param compact_json: Save .json files in the compact format, see BatchWriter
+    :return: The directory, {stage: seconds}, an error message (None on success)
+    and the instrumentation stats of the shot (None if profiling is disabled)
+    """
+    timings = {}
+    instrumentation.reset()
+    shot_name = get_shot_name(directory)
+    out_directory = get_out_directory(directory, shot_root, output_root)
+
+    def timed(stage_name, function, *args, **kwargs):
+        start = time.perf_counter()
+        with instrumentation.stage(stage_name):
+            result = function(*args, **kwargs)
+        timings[stage_name] = timings.get(stage_name, 0) + time.perf_counter() - start
+        return result
+
+    try:
+        files = get_spectrum_files(directory)
+        spectra = None
+        for name, argument in stages:
+            if name == "sum":
+                spe_files = [f for f in files if misc.check_file_extension(f, ".Spe")]
+                spectra = [timed(name, SpectrumProcessor.sum_spectra_files, spe_files, name_modifier=shot_name)]
+                continue
+
+            if spectra is None:
+                spectra = timed("load", SpectrumProcessor.load_multiple_spectra, files, workers=1)
+            if name == "subtract_background":
+                spectra = timed(name, SpectrumProcessor.subtract_background_multiple, spectra,
+                                significance=int(argument or 0))
+            elif name == "filter":
+                timed(name, SpectrumProcessor.filter_multiple, spectra, method=argument or "gauss")
+            elif name == "save":
+                timed(f"{name}:{argument}", save_spectra, spectra, argument, out_directory, compact_json)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    else:
+        error = None
+    return directory, timings, error, instrumentation.get_stats() if instrumentation.ENABLED else None
+
+
+def _init_worker(cache_directory: str | None, profile=False) -> None:
+    misc.INTERACTIVE = False
+    if profile:
+        instrumentation.enable()
+    if cache_directory is not None:
+        SpectrumProcessor.enable_result_cache(cache_directory)
+
+
+def run_pipeline(shot_root: str, stages: list[str], output_root=None, workers=None, use_cache=True,
+                 cache_directory=None, profile=False, compact_json=False) -> dict:
+    """
+    Processes every shot directory below shot_root on a process pool
+    :param shot_root: Directory containing the shot directories
+    :param stages: Stage strings, e.g. ["sum", "subtract_background:3", "save:json"]
+    :param output_root: Root directory for saved files (default: config.processed_path)
+    :param workers: Number of worker processes (default: number of CPUs)
+    :param use_cache: Use the on-disk result cache (see SpectrumProcessor.enable_result_cache)
+    :param cache_directory: The result cache directory (default: ".cache" in output_root)
+    :param profile: Record the stages of all workers, merged into this process's instrumentation report
+    :param compact_json: Save .json files in the compact format, see BatchWriter
+    :return: {shot directory: {"timings": {stage: seconds}, "error": message or None}}
+    """
+    parsed_stages = parse_stages(stages)
+    output_root = output_root or config.processed_path
+    directories = find_shot_directories(shot_root, exclude=output_root)
+    if not directories:
+        raise ValueError(f"No spectrum files found below {shot_root}")
+
+    if use_cache:
+        cache_directory = cache_directory or os.path.join(output_root, ".cache")
+    else:
+        cache_directory = None
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(cache_directory, profile)) as executor:
+        futures = [executor.submit(process_shot, d, parsed_stages, output_root, shot_root, compact_json)
+                   for d in directories]
+        for future in as_completed(futures):
+            directory, timings, error, stats = future.result()
+            if stats is not None:
+                instrumentation.merge_stats(stats)
+            results[directory] = {"timings": timings, "error": error}
+            print(f"{'FAILED' if error else 'Done'}: {directory}" + (f" ({error})" if error else ""))
+    return results
+
+
+def print_timing_summary(results: dict) -> None:
+    totals, counts = {}, {}
+    for result in results.values():
+        for stage, seconds in result["timings"].items():
+            totals[stage] = totals.get(stage, 0) + seconds
+            counts[stage] = counts.get(stage, 0) + 1
+
+    failed = sum(1 for result in results.values() if result["error"])
+    print(f"\n{len(results) - failed} shots processed, {failed} failed")
+    print(f"{'stage':<24}{'shots':>8}{'total, s':>12}{'mean, s':>12}")
+    print("-" * 56)
+    for stage, seconds in totals.items():
+        print(f"{stage:<24}{counts[stage]:>8}{seconds:>12.3f}{seconds / counts[stage]:>12.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("shot_root", type=str, help="Directory containing the shot directories")
+    parser.add_argument("--stages", nargs="+", required=True, help="Processing stages, e.g. sum save:spe")
+    parser.add_argument("--output", type=str, help="Root directory for saved files")
+    parser.add_argument("--workers", type=int, help="Number of worker processes")
+    parser.add_argument("--cache", type=str, help="Result cache directory")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the result cache")
+    parser.add_argument("--profile", type=str, help="Path of the .json profile")
+    parser.add_argument("--compact", action="store_true", help="Write compact .json files")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    pipeline_results = run_pipeline(args.shot_root, args.stages, output_root=args.output, workers=args.workers,
+                                    use_cache=not args.no_cache, cache_directory=args.cache,
+                                    profile=args.profile is not None, compact_json=args.compact)
+    print_timing_summary(pipeline_results)
+    print(f"\nTotal wall time: {time.perf_counter() - start_time:.2f} s")
+    if args.profile:
+        print()
+        instrumentation.print_report()
+        instrumentation.save_report(args.profile)
+        flamegraph_path = os.path.splitext(args.profile)[0] + ".folded"
+        instrumentation.save_flamegraph(flamegraph_path)
+        print(f"\nProfile saved to {args.profile} and {flamegraph_path}")
@@ -1,8 +1,12 @@
 from config import DetectorType
 from gamma_spectrum import GammaSpectrum, SpectrumProcessor
-import matplotlib.pyplot as plt
 import numpy as np
-import plotly.graph_objects as go
+from fit_decay import HalfLifeMap
+from instrumentation import profiled
+
+"""
+Spectrum plots. matplotlib and plotly are imported by the first plot, not when the module is imported
+"""
 
 
 class Plotter:
@@ -10,7 +14,9 @@ class Plotter:
               DetectorType.SMALL_DET: "#F93827"}
 
     @staticmethod
+    @profiled
     def plot(*spectra: GammaSpectrum, energy_scale=False, **kwargs):
+        import matplotlib.pyplot as plt
         for spectrum in spectra:
             if energy_scale:
                 x_data = spectrum.energies
@@ -29,14 +35,25 @@ class Plotter:
         plt.show()
 
     @staticmethod
+    @profiled
     def plot_spectrum(*spectra: GammaSpectrum, scale="energy", plot_background=False, background_significance=0,
                       xlim=None, ylim=None):
-        if scale == "energy":
+        """
+        :param scale: "energy" or "channel" x axis
+        :param xlim: x axis range in keV, converted to channels through the energy calibration for scale="channel"
+        """
+        import plotly.graph_objects as go
+        if scale in ("energy", "channel"):
             fig = go.Figure()
+            if scale == "channel" and xlim is not None:
+                xlim = spectra[0].detector.calibration.energy_to_channel(xlim).tolist()
+
+            def get_x(spectrum: GammaSpectrum):
+                return spectrum.energies if scale == "energy" else spectrum.channels
 
             for spectrum in spectra:
                 fig.add_trace(go.Scatter(
-                    x=spectrum.energies,
+                    x=get_x(spectrum),
                     y=spectrum.counts,
                     mode='lines',
                     name=spectrum.name,
@@ -49,13 +66,12 @@ class Plotter:
                     input("Spectrum measurement time is required for background plotting.\n"
                           "Enter the time (in sec.): ").strip())
                 background_spectrum = SpectrumProcessor().get_normalized_background(spectra[0].detector.type,
-                                                                                    spectrum_time)
-                min_nonzero_bg = min(bg for bg in background_spectrum.counts if bg > 0)
-                background_spectrum.counts = [bg if bg > 0 else min_nonzero_bg for bg in background_spectrum.counts]
+                                                                                    spectrum_time,
+                                                                                    replace_zeros=True)
 
                 # Adding the normalized background line
                 fig.add_trace(go.Scatter(
-                    x=background_spectrum.energies,
+                    x=get_x(background_spectrum),
                     y=background_spectrum.counts,
                     mode='lines',
                     name="Background",
@@ -65,8 +81,8 @@ class Plotter:
                 if background_significance:
                     # Adding the significance interval
                     fig.add_trace(go.Scatter(
-                        x=background_spectrum.energies,
-                        y=[x + background_significance * np.sqrt(x) for x in background_spectrum.counts],
+                        x=get_x(background_spectrum),
+                        y=background_spectrum.counts + background_significance * np.sqrt(background_spectrum.counts),
                         mode='lines',
                         line=dict(color="grey"),
                         name="+3σ region",
@@ -75,7 +91,7 @@ class Plotter:
 
             fig.update_layout(
                 xaxis=dict(
-                    title="Energy (keV)",
+                    title="Energy (keV)" if scale == "energy" else "Channel",
                     title_font=dict(size=22),
                     tickfont=dict(size=18),
                     range=xlim
@@ -92,3 +108,20 @@ class Plotter:
             )
 
             fig.show(config={"toImageButtonOptions": {"filename": spectra[0].name}})
+
+    @staticmethod
+    @profiled
+    def plot_half_life_map(half_life_map: HalfLifeMap, max_relative_error=0.5, **kwargs):
+        """
+        Plots half-lives against energy for the bins/ROIs whose half-life is known to better than max_relative_error
+        """
+        import matplotlib.pyplot as plt
+        half_lives = half_life_map.half_lives
+        errors = half_life_map.half_life_errors
+        shown = half_life_map.valid & np.isfinite(half_lives) & (errors < max_relative_error * half_lives)
+
+        plt.errorbar(half_life_map.energies[shown], half_lives[shown], yerr=errors[shown], fmt="o", **kwargs)
+        plt.xlabel("Energy (keV)")
+        plt.ylabel("Half-life (sec)")
+        plt.yscale("log")
+        plt.show()
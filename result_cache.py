@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import types
+import numpy as np
+
+"""
+On-disk cache of processing results.
+Results are stored as pickles named by a key hashed from the input contents, the operation, its parameters,
+the detector calibration and the version of the processing code, so a result is reused exactly when
+none of these changed. The cache directory is kept below max_bytes by evicting the least recently used entries.
+"""
+
+# Modules storing results in the cache. Their source and that of the project modules they use
+# (directly or through other project modules) defines the results: editing any of them invalidates the cache
+CACHING_MODULES = ("gamma_spectrum", "export")
+
+ENTRY_EXTENSION = ".pkl"
+
+
+def get_code_modules() -> list[str]:
+    """
+    Names of the loaded project modules used by CACHING_MODULES, including themselves
+    """
+    project_directory = os.path.dirname(os.path.abspath(__file__))
+    found = set()
+    pending = [sys.modules[name] for name in CACHING_MODULES if name in sys.modules]
+    while pending:
+        module = pending.pop()
+        path = getattr(module, "__file__", None)
+        if module.__name__ in found or not path or os.path.dirname(os.path.abspath(path)) != project_directory:
+            continue
+        found.add(module.__name__)
+        for value in vars(module).values():
+            if not isinstance(value, types.ModuleType):
+                # Imported functions and classes, e.g. "from detector_manager import Detector"
+                value = sys.modules.get(getattr(value, "__module__", None) or "")
+            if value is not None and value.__name__ not in found:
+                pending.append(value)
+    return sorted(found)
+
+
+def get_code_version() -> str:
+    """
+    Hash of the source code of get_code_modules()
+    """
+    digest = hashlib.sha256()
+    for module_name in get_code_modules():
+        with open(sys.modules[module_name].__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    A size-bounded, content-addressed store of pickled results
+    """
+
+    def __init__(self, directory: str, max_bytes=512 * 1024 ** 2):
+        """
+        :param directory: Directory holding the cache entries, created if missing
+        :param max_bytes: Maximum total size of the entries, least recently used are evicted first
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.code_version = None
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._file_hashes = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def file_hash(self, path: str) -> str:
+        """
+        SHA-256 of a file's content, remembered while its size and mtime are unchanged
+        """
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self._file_hashes.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 ** 2), b""):
+                digest.update(block)
+        self._file_hashes[path] = signature, digest.hexdigest()
+        return digest.hexdigest()
+
+    @staticmethod
+    def spectrum_hash(spectrum) -> str:
+        """
+        SHA-256 of everything a GammaSpectrum's processing results and saved files depend on
+        """
+        digest = hashlib.sha256()
+        for value in (spectrum.name, spectrum.file_extension, spectrum.detector.name if spectrum.detector else None,
+                      spectrum.zeros_dropped):
+            digest.update(repr(value).encode())
+        for value in (spectrum.header, spectrum.footer):
+            digest.update(b"\0" if value is None else value)
+        for array in (spectrum.counts, spectrum.times, spectrum.channels, spectrum.energies):
+            if array is None:
+                digest.update(b"\0")
+            else:
+                array = np.ascontiguousarray(array)
+                digest.update(f"{array.dtype.str}{array.shape}".encode())
+                digest.update(array.data)
+        return digest.hexdigest()
+
+    def detector_hash(self, detector, include_background=False) -> str:
+        """
+        Hash of the detector calibration, and optionally of its background file
+        """
+        description = [detector.name, list(detector.calibration.coefficients), len(detector.calibration),
+                       list(detector.bg_times)]
+        if include_background:
+            description.append(self.file_hash(detector.bg_path))
+        return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+    def make_key(self, operation: str, input_hash: str, params=None, detector_hash=None) -> str:
+        """
+        :param operation: Name of the operation producing the result
+        :param input_hash: Hash of the input, see file_hash and spectrum_hash
+        :param params: JSON-serializable parameters of the operation
+        :param detector_hash: See detector_hash
+        :return: The cache key
+        """
+        if self.code_version is None:
+            self.code_version = get_code_version()
+        description = json.dumps([operation, input_hash, params, detector_hash, self.code_version],
+                                 sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ENTRY_EXTENSION)
+
+    def get(self, key: str):
+        """
+        :return: The cached result, or None if there is none
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key: str, result) -> None:
+        """
+        Stores a result. The entry is written to a temporary file first, so concurrent readers
+        (e.g. pipeline worker processes) never see partial entries
+        """
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self._entry_path(key))
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._list_entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def get_or_compute(self, key: str, compute):
+        """
+        Returns the cached result for key, computing and storing it with compute() if it is missing
+        """
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def _list_entries(self) -> list[tuple]:
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(ENTRY_EXTENSION):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self) -> None:
+        entries = sorted(self._list_entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            for path, _, _ in self._list_entries():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._size = 0
+            self._file_hashes.clear()
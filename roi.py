@@ -0,0 +1,125 @@
+import numpy as np
+import config
+from detector_manager import Detector
+from instrumentation import profiled
+
+"""
+ROI (region of interest) integration over spectrum stacks.
+Cumulative sums are built once per stack, after which the gross and net areas of any ROI
+in all spectra are two lookups per spectrum.
+"""
+
+FOOTER_START = config.spectra_files["footer_start"].encode()
+
+
+class RoiAreas:
+    """
+    Gross and net ROI areas with their Poisson uncertainties, shape (n_spectra x n_rois)
+    """
+    __slots__ = ("rois", "gross", "gross_errors", "net", "net_errors")
+
+    def __init__(self, rois, gross, gross_errors, net, net_errors):
+        self.rois = rois
+        self.gross = gross
+        self.gross_errors = gross_errors
+        self.net = net
+        self.net_errors = net_errors
+
+
+def parse_roi_footer(footer: bytes) -> np.ndarray:
+    """
+    Reads the $ROI block of a .Spe footer:
+        $ROI:
+        <number of ROIs>
+        <first channel> <last channel>
+        ...
+    :return: (n_rois x 2) array of first and last channels (inclusive)
+    """
+    lines = footer[footer.find(FOOTER_START):].splitlines()
+    n_rois = int(lines[1].split()[0]) if len(lines) > 1 else 0
+    if not n_rois:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.array([line.split()[:2] for line in lines[2:2 + n_rois]], dtype=np.int64)
+
+
+def rois_from_energies(detector: Detector, energy_rois) -> np.ndarray:
+    """
+    Converts ROIs given in keV into channel ROIs through the detector's energy calibration
+    :param detector: The detector of the spectra
+    :param energy_rois: (n_rois x 2) first and last energies in keV
+    :return: (n_rois x 2) first and last channels
+    """
+    return detector.calibration.energy_to_channel(np.asarray(energy_rois, dtype=np.float64).reshape(-1, 2))
+
+
+class RoiIntegrator:
+    """
+    Answers ROI area queries for every spectrum of a stack
+    """
+    __slots__ = ("cumulative",)
+
+    def __init__(self, counts: np.ndarray):
+        """
+        :param counts: (n_spectra x channels) counts, e.g. SpectrumStack.counts
+        """
+        counts = np.atleast_2d(counts)
+        dtype = np.int64 if np.issubdtype(counts.dtype, np.integer) else np.float64
+        self.cumulative = np.zeros((counts.shape[0], counts.shape[1] + 1), dtype=dtype)
+        np.cumsum(counts, axis=1, out=self.cumulative[:, 1:])
+
+    def _sum(self, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        return self.cumulative[:, ends + 1] - self.cumulative[:, starts]
+
+    def gross(self, channel_start: int, channel_end: int) -> np.ndarray:
+        """
+        Sum of counts in [channel_start, channel_end] for every spectrum
+        """
+        return self.cumulative[:, channel_end + 1] - self.cumulative[:, channel_start]
+
+    @profiled
+    def areas(self, rois, edge_channels=3) -> RoiAreas:
+        """
+        Gross and net areas of multiple ROIs in all spectra, see get_roi_areas
+        :param rois: (n_rois x 2) first and last channels (inclusive)
+        :param edge_channels: Number of channels averaged at each ROI end for the background
+        :return: RoiAreas with (n_spectra x n_rois) arrays
+        """
+        return get_roi_areas(rois, self.cumulative.shape[1] - 1, self._sum, edge_channels)
+
+
+def get_roi_areas(rois, n_channels: int, range_sum, edge_channels=3) -> RoiAreas:
+    """
+    Gross and net areas of multiple ROIs.
+    The net area subtracts a linear (trapezoid) background estimated from the mean of
+    edge_channels channels at both ends of the ROI, as in GammaVision
+    :param rois: (n_rois x 2) first and last channels (inclusive)
+    :param n_channels: Number of channels of the spectra
+    :param range_sum: Returns the (n_spectra x n_rois) sums of counts in [starts, ends] for arrays of first
+    and last channels, e.g. RoiIntegrator._sum
+    :param edge_channels: Number of channels averaged at each ROI end for the background
+    :return: RoiAreas with (n_spectra x n_rois) arrays
+    """
+    rois = np.asarray(rois, dtype=np.int64).reshape(-1, 2)
+    starts, ends = rois[:, 0], rois[:, 1]
+    if np.any(starts > ends) or np.any(starts < 0) or np.any(ends >= n_channels):
+        raise ValueError("ROIs must satisfy 0 <= first channel <= last channel < number of channels")
+
+    gross = range_sum(starts, ends)
+    width = ends - starts + 1
+    edges = np.clip(np.minimum(edge_channels, width // 2), 1, None)
+    left = range_sum(starts, starts + edges - 1)
+    right = range_sum(ends - edges + 1, ends)
+    background_factor = width / (2 * edges)
+    background = (left + right) * background_factor
+    net = gross - background
+
+    # The edge channels are part of the gross area: net = middle + (1 - factor) * (left + right)
+    net_variance = np.where(width >= 2 * edges,
+                            gross - (left + right) + (1 - background_factor) ** 2 * (left + right),
+                            gross + background_factor ** 2 * (left + right))
+
+    return RoiAreas(rois=rois,
+                    gross=gross,
+                    gross_errors=np.sqrt(gross),
+                    net=net,
+                    net_errors=np.sqrt(np.clip(net_variance, 0, None)))
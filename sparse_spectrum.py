@@ -0,0 +1,202 @@
+import json
+import os
+import numpy as np
+import misc
+import export
+import instrumentation
+from detector_manager import Detector
+from gamma_spectrum import GammaSpectrum, get_sum_name, sparse_to_dense
+from roi import RoiAreas, get_roi_areas
+from instrumentation import profiled
+
+"""
+Sparse spectra.
+After background subtraction with a significance cut most channels are exactly zero. A SparseSpectrum keeps
+only the indices and counts of the nonzero channels: it is saved and loaded as sparse .json or .npz,
+named "{name}_sparse" (GammaSpectrum.load reads these files as dense spectra), and summed, scaled and ROI-integrated
+without expanding it to all channels.
+"""
+
+INDEX_DTYPE = np.int32
+
+
+class SparseSpectrum:
+    """
+    A spectrum stored as the sorted indices and values of its nonzero channels.
+    The arrays are shared between spectra: operations return new spectra instead of modifying them in place
+    """
+    __slots__ = ("name", "detector", "times", "length", "indices", "values")
+
+    def __init__(self, name: str, detector: Detector, times, length: int, indices: np.ndarray, values: np.ndarray):
+        """
+        :param times: Live and real time, or None
+        :param length: Number of channels of the dense spectrum
+        :param indices: Sorted channels of the nonzero counts
+        :param values: Counts of these channels
+        """
+        self.name = name
+        self.detector = detector
+        self.times = times
+        self.length = length
+        self.indices = indices
+        self.values = values
+
+    @staticmethod
+    def from_counts(counts: np.ndarray, name: str, detector: Detector, times=None) -> "SparseSpectrum":
+        indices = np.flatnonzero(counts).astype(INDEX_DTYPE)
+        return SparseSpectrum(name, detector, times, len(counts), indices, counts[indices])
+
+    @staticmethod
+    def from_spectrum(spectrum: GammaSpectrum) -> "SparseSpectrum":
+        return SparseSpectrum.from_counts(spectrum.counts, spectrum.name, spectrum.detector, spectrum.times)
+
+    @property
+    def nnz(self) -> int:
+        """
+        Number of nonzero channels
+        """
+        return len(self.indices)
+
+    @property
+    def density(self) -> float:
+        """
+        Fraction of nonzero channels
+        """
+        return self.nnz / self.length if self.length else 0.0
+
+    def to_counts(self) -> np.ndarray:
+        return sparse_to_dense(self.length, self.indices, self.values)
+
+    def to_spectrum(self) -> GammaSpectrum:
+        """
+        The dense GammaSpectrum with channels and energies
+        """
+        spectrum = GammaSpectrum()
+        spectrum.name = self.name
+        spectrum.detector = self.detector
+        spectrum.times = self.times
+        spectrum.counts = self.to_counts()
+        spectrum.length = self.length
+        spectrum.file_extension = ".json"
+        spectrum.fill_channels()
+        spectrum.fill_energies()
+        return spectrum
+
+    def scale(self, factor: float, name_modifier="") -> "SparseSpectrum":
+        """
+        :return: A new spectrum with the counts multiplied by factor
+        """
+        if factor == 0:
+            return SparseSpectrum(self.name + name_modifier, self.detector, self.times, self.length,
+                                  self.indices[:0], self.values[:0] * factor)
+        return SparseSpectrum(self.name + name_modifier, self.detector, self.times, self.length, self.indices,
+                              self.values * factor)
+
+    def _cumulative(self) -> np.ndarray:
+        dtype = np.int64 if np.issubdtype(self.values.dtype, np.integer) else np.float64
+        cumulative = np.zeros(len(self.values) + 1, dtype=dtype)
+        np.cumsum(self.values, out=cumulative[1:])
+        return cumulative
+
+    def _sum(self, starts: np.ndarray, ends: np.ndarray, cumulative=None) -> np.ndarray:
+        if cumulative is None:
+            cumulative = self._cumulative()
+        return (cumulative[np.searchsorted(self.indices, ends, side="right")] -
+                cumulative[np.searchsorted(self.indices, starts, side="left")])[np.newaxis]
+
+    def gross(self, channel_start: int, channel_end: int):
+        """
+        Sum of counts in [channel_start, channel_end]
+        """
+        return self._sum(np.array([channel_start]), np.array([channel_end]))[0, 0]
+
+    @profiled
+    def areas(self, rois, edge_channels=3) -> RoiAreas:
+        """
+        Gross and net areas of multiple ROIs, see roi.get_roi_areas
+        :param rois: (n_rois x 2) first and last channels (inclusive)
+        :param edge_channels: Number of channels averaged at each ROI end for the background
+        :return: RoiAreas with (1 x n_rois) arrays
+        """
+        cumulative = self._cumulative()
+        return get_roi_areas(rois, self.length, lambda starts, ends: self._sum(starts, ends, cumulative),
+                             edge_channels)
+
+    @profiled
+    def save_json(self, out_directory: str, filename_suffix="") -> None:
+        out_path = os.path.join(out_directory, self.name + filename_suffix + export.SPARSE_SUFFIX + ".json")
+        if not os.path.exists(out_directory):
+            os.makedirs(out_directory)
+
+        export.write_output(self, out_path, lambda: export.render_sparse_json(self), "save_sparse_json")
+        print(f"File saved: {out_path}")
+
+    @profiled
+    def save_npz(self, out_directory: str, filename_suffix="") -> None:
+        out_path = os.path.join(out_directory,
+                                self.name + filename_suffix + export.SPARSE_SUFFIX + export.NPZ_EXTENSION)
+        if not os.path.exists(out_directory):
+            os.makedirs(out_directory)
+
+        export.write_sparse_npz(self, out_path)
+        print(f"File saved: {out_path}")
+
+    @staticmethod
+    @profiled
+    def load(path: str) -> "SparseSpectrum":
+        """
+        Loads a sparse .json or .npz file written by save_json, save_npz or BatchWriter.save_sparse
+        """
+        extension = os.path.splitext(path)[1]
+        if instrumentation.ENABLED:
+            instrumentation.add_bytes_read(os.path.getsize(path))
+        if extension == ".json":
+            with open(path) as f:
+                file_contents = json.load(f)
+            metadata, data = file_contents["metadata"], file_contents["data"]
+            if metadata.get("format") != export.SPARSE_FORMAT:
+                raise ValueError(f"{path} is not a sparse spectrum file")
+            times = metadata["spectrum_recording_times"]
+            return SparseSpectrum(metadata["spectrum_name"],
+                                  Detector(misc.get_detector_from_filename(metadata["detector"])),
+                                  np.asarray(times) if times is not None else None, data["length"],
+                                  np.asarray(data["indices"], dtype=INDEX_DTYPE), np.asarray(data["counts"]))
+
+        if extension == export.NPZ_EXTENSION:
+            with np.load(path) as arrays:
+                if "indices" not in arrays:
+                    raise ValueError(f"{path} is not a sparse spectrum file")
+                return SparseSpectrum(str(arrays["name"]),
+                                      Detector(misc.get_detector_from_filename(str(arrays["detector"]))),
+                                      arrays["times"] if "times" in arrays else None, int(arrays["length"]),
+                                      arrays["indices"], arrays["values"])
+
+        raise ValueError("Unsupported file format")
+
+
+@profiled
+def sum_sparse(spectra: list[SparseSpectrum], name_modifier: str) -> SparseSpectrum:
+    """
+    Sums sparse spectra of the same detector and length, only touching their nonzero channels
+    :param spectra: The spectra to sum, in file number order
+    :param name_modifier: See SpectrumProcessor.sum_spectra
+    :return: A new SparseSpectrum with the summed counts and times
+    """
+    first, last = spectra[0], spectra[-1]
+    if any(sp.length != first.length or sp.detector is not first.detector for sp in spectra):
+        raise ValueError("Only spectra of the same detector and length can be summed")
+
+    channels, inverse = np.unique(np.concatenate([sp.indices for sp in spectra]), return_inverse=True)
+    values = np.concatenate([sp.values for sp in spectra])
+    summed = np.bincount(inverse, weights=values, minlength=len(channels))
+    if np.issubdtype(values.dtype, np.unsignedinteger):
+        summed = summed.astype(GammaSpectrum.SUM_DTYPE)
+    elif np.issubdtype(values.dtype, np.integer):
+        summed = summed.astype(np.int64)
+    nonzero = summed != 0
+
+    times = None
+    if all(sp.times is not None for sp in spectra):
+        times = np.sum([sp.times for sp in spectra], axis=0)
+    return SparseSpectrum(get_sum_name(first.detector, name_modifier, first.name, last.name), first.detector, times,
+                          first.length, channels[nonzero].astype(INDEX_DTYPE), summed[nonzero])
@@ -0,0 +1,165 @@
+import numpy as np
+import config
+import instrumentation
+from instrumentation import profiled
+
+"""
+Fast reader for ORTEC .Spe files.
+The header and footer are located with byte searches and kept as raw bytes,
+the counts block is parsed in one vectorized call.
+"""
+
+TIME_LINE = config.spectra_files["time_line"]
+HEADER_END = config.spectra_files["header_end"].encode()
+FOOTER_START = config.spectra_files["footer_start"].encode()
+
+COUNTS_DTYPE = np.uint32
+
+
+class SpeData:
+    """
+    The raw contents of a .Spe file
+    """
+    __slots__ = ("header", "footer", "counts", "times", "data_start", "data_end")
+
+    def __init__(self, header: bytes, footer: bytes, counts: np.ndarray, times: np.ndarray, data_start: int,
+                 data_end: int):
+        self.header = header
+        self.footer = footer
+        self.counts = counts
+        self.times = times
+        self.data_start = data_start
+        self.data_end = data_end
+
+
+def find_data_start(data: bytes) -> int:
+    """
+    :param data: The file contents, or at least its beginning
+    :return: Byte offset of the first count line
+    """
+    marker = data.find(HEADER_END)
+    if marker < 0:
+        raise ValueError(f"{HEADER_END.decode()} not found")
+    # The counts start after the $DATA line and the channel range line following it
+    range_line_start = data.index(b"\n", marker) + 1
+    return data.index(b"\n", range_line_start) + 1
+
+
+def find_data_block(data: bytes) -> (int, int):
+    """
+    Locates the counts block of a .Spe file
+    :param data: The file contents
+    :return: Byte offsets of the first count line and of the footer start ($ROI line)
+    """
+    data_start = find_data_start(data)
+    footer_marker = data.rfind(FOOTER_START)
+    if footer_marker < data_start:
+        raise ValueError(f"{FOOTER_START.decode()} not found")
+    data_end = data.rfind(b"\n", 0, footer_marker) + 1
+    return data_start, data_end
+
+
+def parse_times(header: bytes) -> np.ndarray:
+    """
+    Reads the live and real measurement times from a .Spe header
+    """
+    return np.array(header.splitlines()[TIME_LINE].split(), dtype=np.int64)
+
+
+def parse_channel_range(data: bytes, data_start: int) -> (int, int):
+    """
+    Reads the first and last channel from the line preceding the counts block
+    """
+    first_channel, last_channel = map(int, data[data.rfind(b"\n", 0, data_start - 1) + 1:data_start].split())
+    return first_channel, last_channel
+
+
+def parse_counts(data: bytes, data_start: int, data_end: int, out_dtype=COUNTS_DTYPE) -> np.ndarray:
+    """
+    Parses the counts block of a .Spe file and checks it against the channel range given in the header
+    """
+    first_channel, last_channel = parse_channel_range(data, data_start)
+    counts = np.fromstring(data[data_start:data_end], dtype=out_dtype, sep=" ")
+    if len(counts) != last_channel - first_channel + 1:
+        raise ValueError(f"Expected {last_channel - first_channel + 1} channels, found {len(counts)}")
+    return counts
+
+
+def parse_spe(data: bytes) -> SpeData:
+    """
+    Parses the contents of a .Spe file
+    :param data: The raw file contents
+    :return: SpeData with the header and footer as raw bytes and the counts as an ndarray
+    """
+    data_start, data_end = find_data_block(data)
+    header = data[:data_start]
+    return SpeData(header=header,
+                   footer=data[data_end:],
+                   counts=parse_counts(data, data_start, data_end),
+                   times=parse_times(header),
+                   data_start=data_start,
+                   data_end=data_end)
+
+
+@profiled
+def read_spe(path: str) -> SpeData:
+    """
+    Reads a .Spe file
+    :param path: The path to the .Spe file
+    :return: SpeData
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    instrumentation.add_bytes_read(len(data))
+    return parse_spe(data)
+
+
+@profiled
+def read_spe_header(path: str, block_size=4096) -> SpeData:
+    """
+    Reads only the header of a .Spe file, stopping at the start of the counts block
+    :param path: The path to the .Spe file
+    :param block_size: Number of bytes read at a time
+    :return: SpeData with the header, times and data_start set. counts, footer and data_end are None
+    """
+    data = b""
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            data += block
+            try:
+                data_start = find_data_start(data)
+                break
+            except ValueError:
+                if not block:
+                    raise
+    instrumentation.add_bytes_read(len(data))
+    header = data[:data_start]
+    return SpeData(header=header, footer=None, counts=None, times=parse_times(header), data_start=data_start,
+                   data_end=None)
+
+
+def replace_times(header: bytes, new_times) -> bytes:
+    """
+    Replaces the data acquisition times line in a raw .Spe header
+    """
+    lines = header.splitlines(keepends=True)
+    line = lines[TIME_LINE]
+    newline = line[len(line.rstrip(b"\r\n")):]
+    lines[TIME_LINE] = f"{new_times[0]} {new_times[1]}".encode() + newline
+    return b"".join(lines)
+
+
+def get_newline(header: bytes) -> bytes:
+    return b"\r\n" if header.endswith(b"\r\n") else b"\n"
+
+
+def format_counts(counts: np.ndarray, newline=b"\n", width=0) -> bytes:
+    """
+    Formats counts as the .Spe data block, one value per line
+    :param width: Right-align the values to this many characters (e.g. 8 as in ORTEC files), 0 = no padding
+    """
+    newline = newline.decode()
+    if width:
+        return "".join(f"{count:{width}d}{newline}" for count in counts.tolist()).encode()
+    return (newline.join(map(str, counts.tolist())) + newline).encode()
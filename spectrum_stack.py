@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import struct
+import numpy as np
+import misc
+import spe_reader
+from config import DetectorType
+from detector_manager import Detector
+from directory_index import get_index
+
+"""
+Binary per-shot spectrum stack.
+A shot directory of .Spe files is converted once into a single .gstack file which is then opened through np.memmap,
+so slicing a range of files or a channel window only reads those bytes.
+
+File layout:
+    preamble (ALIGNMENT bytes): MAGIC, metadata offset (uint64), metadata length (uint64)
+    counts: (n_spectra x channels) matrix of uint32, C order
+    metadata: JSON with the detector, names, file numbers, times, headers and footers
+
+Usage:
+python spectrum_stack.py "input_path" --output "output_path"
+"input_path": Directory with the .Spe files of one shot
+--output "output_path": The .gstack file to write (default: "input_path" + .gstack)
+"""
+
+
+class SpectrumStack:
+    """
+    A time-ordered stack of spectra of one detector, backed by a memory-mapped .gstack file
+    """
+    EXTENSION = ".gstack"
+    MAGIC = b"GSTACK01"
+    ALIGNMENT = 4096
+    COUNTS_DTYPE = np.dtype("<u4")
+
+    __slots__ = ("path", "detector", "counts", "times", "file_numbers", "names", "headers", "footers")
+
+    def __init__(self):
+        self.path = None
+        self.detector = None
+        self.counts = None
+        self.times = None
+        self.file_numbers = None
+        self.names = None
+        self.headers = None
+        self.footers = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def channels(self) -> int:
+        return self.counts.shape[1]
+
+    @staticmethod
+    def import_directory(directory: str, out_path=None) -> str:
+        """
+        Converts all .Spe files of a directory into a .gstack file, ordered by their file number.
+        The files are parsed one at a time and written directly to the stack
+        :param directory: Directory with the .Spe files of one shot
+        :param out_path: The .gstack file to write (default: the directory path + .gstack)
+        :return: The path of the written stack
+        """
+        files = get_index(directory).paths(extensions=[".Spe"])
+        if not files:
+            raise ValueError(f"No .Spe files found in {directory}")
+        return SpectrumStack.write(files, out_path or directory.rstrip("\\/") + SpectrumStack.EXTENSION)
+
+    @staticmethod
+    def write(files: list[str], out_path: str) -> str:
+        """
+        Writes the given .Spe files, in the given order, into a .gstack file
+        :return: out_path
+        """
+        detector = Detector(misc.get_detector_from_filename(files[0]))
+        metadata = {"detector": detector.type.name, "dtype": SpectrumStack.COUNTS_DTYPE.str, "names": [],
+                    "file_numbers": [], "times": [], "headers": [], "footers": []}
+        channels = None
+
+        if os.path.dirname(out_path) and not os.path.exists(os.path.dirname(out_path)):
+            os.makedirs(os.path.dirname(out_path))
+
+        with open(out_path, "wb") as f:
+            f.write(b"\0" * SpectrumStack.ALIGNMENT)
+            for path in files:
+                spe = spe_reader.read_spe(path)
+                if channels is None:
+                    channels = len(spe.counts)
+                elif len(spe.counts) != channels:
+                    raise ValueError(f"{path}: expected {channels} channels, found {len(spe.counts)}")
+                f.write(spe.counts.astype(SpectrumStack.COUNTS_DTYPE, copy=False).tobytes())
+
+                name = os.path.splitext(os.path.basename(path))[0]
+                metadata["names"].append(name)
+                metadata["file_numbers"].append(misc.get_spectrum_number(name))
+                metadata["times"].append(spe.times.tolist())
+                metadata["headers"].append(spe.header.decode("latin-1"))
+                metadata["footers"].append(spe.footer.decode("latin-1"))
+
+            metadata["shape"] = [len(files), channels]
+            metadata_offset = f.tell()
+            metadata_bytes = json.dumps(metadata, separators=(",", ":")).encode()
+            f.write(metadata_bytes)
+            f.seek(0)
+            f.write(SpectrumStack.MAGIC + struct.pack("<QQ", metadata_offset, len(metadata_bytes)))
+
+        print(f"File saved: {out_path}")
+        return out_path
+
+    @staticmethod
+    def open(path: str) -> "SpectrumStack":
+        """
+        Opens a .gstack file. The counts are memory-mapped read-only, nothing is read until they are accessed
+        """
+        with open(path, "rb") as f:
+            preamble = f.read(len(SpectrumStack.MAGIC) + 16)
+            if preamble[:len(SpectrumStack.MAGIC)] != SpectrumStack.MAGIC:
+                raise ValueError(f"{path} is not a spectrum stack file")
+            metadata_offset, metadata_length = struct.unpack("<QQ", preamble[len(SpectrumStack.MAGIC):])
+            f.seek(metadata_offset)
+            metadata = json.loads(f.read(metadata_length))
+
+        stack = SpectrumStack()
+        stack.path = path
+        stack.detector = Detector(DetectorType[metadata["detector"]])
+        n_spectra, channels = metadata["shape"]
+        if n_spectra:
+            stack.counts = np.memmap(path, dtype=np.dtype(metadata["dtype"]), mode="r",
+                                     offset=SpectrumStack.ALIGNMENT, shape=(n_spectra, channels))
+        else:
+            stack.counts = np.empty((0, channels or 0), dtype=np.dtype(metadata["dtype"]))
+        stack.times = np.array(metadata["times"], dtype=np.int64).reshape(n_spectra, 2)
+        stack.file_numbers = np.array(metadata["file_numbers"], dtype=np.int64)
+        stack.names = metadata["names"]
+        stack.headers = [h.encode("latin-1") for h in metadata["headers"]]
+        stack.footers = [h.encode("latin-1") for h in metadata["footers"]]
+        return stack
+
+    def get_range(self, start=None, end=None) -> slice:
+        """
+        Converts a range of file numbers (both inclusive) into a slice of stack rows
+        :param start: First file number (default: the first file)
+        :param end: Last file number (default: the last file)
+        """
+        first = 0 if start is None else int(np.searchsorted(self.file_numbers, start, side="left"))
+        last = len(self) if end is None else int(np.searchsorted(self.file_numbers, end, side="right"))
+        return slice(first, last)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", type=str, help="Path to the folder with the .Spe files of one shot")
+    parser.add_argument("--output", type=str, help="The .gstack file to write")
+    args = parser.parse_args()
+
+    SpectrumStack.import_directory(args.input_path, args.output)
@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import numpy as np
+
+"""
+Synthetic test data.
+Generates a shot of Poisson-distributed spectra with decaying Gaussian peaks on an exponential continuum,
+written as ORTEC .Spe files (and optionally as .csv and .json in the formats written by GammaSpectrum),
+together with a long background measurement and a config.py pointing to them.
+This module does not import config, so it can be used before a config exists.
+
+Usage:
+python synthetic_data.py "output_path" --files 100 --formats spe csv json --seed 0
+"output_path": Directory to write the data set to
+--files: Number of measurement files
+--formats: File formats to write (default: spe)
+--seed: Seed of the random generator
+"""
+
+CHANNELS = 8191
+DETECTOR = "BigDet"
+SHOT = 1
+LIVE_TIME = 300
+DEAD_TIME = 5
+BACKGROUND_LIVE_TIME = 86400
+ENERGY_CALIBRATION = {"intercept": 0.12, "slope": 0.2461}
+
+# (channel, net counts per second at t = 0, sigma in channels, half-life in seconds)
+DEFAULT_PEAKS = ((1300, 2.0, 2.5, 9000.0), (2745, 5.0, 3.0, 2000.0), (5000, 0.5, 4.0, float("inf")))
+# (counts per second per channel at channel 0, decay length in channels)
+DEFAULT_CONTINUUM = (0.02, 2500.0)
+
+FORMATS = ("spe", "csv", "json")
+
+
+def continuum_rate(channels: np.ndarray, continuum=DEFAULT_CONTINUUM) -> np.ndarray:
+    amplitude, length = continuum
+    return amplitude * np.exp(-channels / length)
+
+
+def expected_counts(start_time: float, live_time: float, peaks=DEFAULT_PEAKS, continuum=DEFAULT_CONTINUUM,
+                    channels=CHANNELS) -> np.ndarray:
+    """
+    Expected counts per channel of a measurement starting start_time seconds after the shot
+    """
+    x = np.arange(channels, dtype=np.float64)
+    expected = continuum_rate(x, continuum) * live_time
+    for center, rate, sigma, half_life in peaks:
+        decay_constant = np.log(2) / half_life
+        # Integral of the decaying rate over the measurement
+        if decay_constant:
+            area = rate * np.exp(-decay_constant * start_time) * -np.expm1(-decay_constant * live_time) / decay_constant
+        else:
+            area = rate * live_time
+        expected += area * np.exp(-0.5 * ((x - center) / sigma) ** 2) / (sigma * np.sqrt(2 * np.pi))
+    return expected
+
+
+def get_rois(peaks=DEFAULT_PEAKS) -> list[tuple[int, int]]:
+    """
+    ±3 sigma channel ROIs around the peaks
+    """
+    return [(int(center - 3 * sigma), int(center + 3 * sigma)) for center, _, sigma, _ in peaks]
+
+
+def format_spe(counts: np.ndarray, times, rois=(), newline="\r\n") -> bytes:
+    """
+    An ORTEC .Spe file: the live/real times are on line 9, the counts follow $DATA:, the ROIs follow $ROI:
+    """
+    header = ["$SPEC_ID:", "Synthetic spectrum", "$SPEC_REM:", "DET# 1", "DETDESC# Synthetic", "AP# synthetic_data.py",
+              "$DATE_MEA:", "01/01/2025 00:00:00", "$MEAS_TIM:", f"{times[0]} {times[1]}", "$DATA:",
+              f"0 {len(counts) - 1}"]
+    footer = ["$ROI:", str(len(rois))] + [f"{start} {end}" for start, end in rois] + [
+        "$PRESETS:", "None", "0", "0",
+        "$ENER_FIT:", f"{ENERGY_CALIBRATION['intercept']:.6f} {ENERGY_CALIBRATION['slope']:.6f}"]
+    lines = header + [f"{c:8d}" for c in counts.tolist()] + footer
+    return (newline.join(lines) + newline).encode()
+
+
+def format_csv(counts: np.ndarray) -> str:
+    return "".join(f"{channel},{count}\r\n" for channel, count in enumerate(counts.tolist()))
+
+
+def format_json(name: str, counts: np.ndarray, times) -> str:
+    channels = np.arange(len(counts))
+    energies = ENERGY_CALIBRATION["intercept"] + ENERGY_CALIBRATION["slope"] * channels
+    return json.dumps({
+        "metadata": {"spectrum_name": name, "detector": DETECTOR, "spectrum_recording_times": list(times)},
+        "data": {"counts": counts.tolist(), "channels": channels.tolist(), "energies": energies.tolist()}
+    })
+
+
+def write_config(out_directory: str, background_path: str) -> str:
+    """
+    Writes a config.py for the data set: one detector with the synthetic background and energy calibration
+    :return: The path of the config
+    """
+    processed_path = os.path.join(out_directory, "processed")
+    contents = f'''import os
+from enum import Enum
+
+
+class DetectorType(Enum):
+    BIG_DET = "{DETECTOR}"
+    SMALL_DET = "SmallDet"
+
+
+logo = "GammaProcessor (synthetic data)"
+SUPPORTED_FILE_EXTENSIONS = [".Spe", ".csv", ".json"]
+spectra_files = {{"time_line": 9, "header_end": "$DATA:", "footer_start": "$ROI:"}}
+detectors = {{
+    detector_type: {{"bg_path": {background_path!r}, "bg_times": [{BACKGROUND_LIVE_TIME}, {BACKGROUND_LIVE_TIME + 100}],
+                     "energy_calibration": {ENERGY_CALIBRATION!r}}}
+    for detector_type in DetectorType
+}}
+processed_path = {processed_path!r}
+save_paths = {{
+    "sums": {{detector_type: {os.path.join(out_directory, "sums")!r} for detector_type in DetectorType}},
+    "processed": {{detector_type: {{subdirectory: os.path.join(processed_path, subdirectory) for subdirectory in
+                                  ("bg_subtracted", "energy_scale", "counts", "filtered")}}
+                  for detector_type in DetectorType}},
+}}
+'''
+    config_path = os.path.join(out_directory, "config.py")
+    with open(config_path, "w") as f:
+        f.write(contents)
+    return config_path
+
+
+def generate_dataset(out_directory: str, n_files: int, formats=("spe",), peaks=DEFAULT_PEAKS,
+                     continuum=DEFAULT_CONTINUUM, seed=0) -> dict:
+    """
+    Writes a synthetic shot of n_files measurements, a background and a config.py
+    :param out_directory: Directory of the data set
+    :param n_files: Number of measurement files
+    :param formats: File formats of the measurements, see FORMATS
+    :param peaks: (channel, counts per second, sigma, half-life) of the peaks
+    :param continuum: (counts per second per channel at channel 0, decay length in channels)
+    :param seed: Seed of the random generator
+    :return: {"config": path, "background": path, format: [measurement paths]}
+    """
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"Unknown formats {', '.join(unknown)}, expected some of {', '.join(FORMATS)}")
+    rng = np.random.default_rng(seed)
+    # The config is imported from other working directories
+    out_directory = os.path.abspath(out_directory)
+    os.makedirs(out_directory, exist_ok=True)
+
+    background_directory = os.path.join(out_directory, "background")
+    os.makedirs(background_directory, exist_ok=True)
+    background_path = os.path.join(background_directory, f"{DETECTOR}_background.Spe")
+    background = rng.poisson(continuum_rate(np.arange(CHANNELS, dtype=np.float64), continuum) * BACKGROUND_LIVE_TIME)
+    with open(background_path, "wb") as f:
+        f.write(format_spe(background, (BACKGROUND_LIVE_TIME, BACKGROUND_LIVE_TIME + 100)))
+
+    paths = {"config": write_config(out_directory, background_path), "background": background_path}
+    rois = get_rois(peaks)
+    for out_format in formats:
+        os.makedirs(os.path.join(out_directory, f"{DETECTOR}_Shot_{SHOT}", out_format), exist_ok=True)
+        paths[out_format] = []
+
+    for i in range(n_files):
+        counts = rng.poisson(expected_counts(i * (LIVE_TIME + DEAD_TIME), LIVE_TIME, peaks, continuum))
+        times = (LIVE_TIME, LIVE_TIME + DEAD_TIME)
+        name = f"{DETECTOR}_Shot_{SHOT} {i + 1:03d}"
+        for out_format in formats:
+            path = os.path.join(out_directory, f"{DETECTOR}_Shot_{SHOT}", out_format,
+                                f"{name}.{'Spe' if out_format == 'spe' else out_format}")
+            if out_format == "spe":
+                with open(path, "wb") as f:
+                    f.write(format_spe(counts, times, rois))
+            else:
+                with open(path, "w", newline="") as f:
+                    f.write(format_csv(counts) if out_format == "csv" else format_json(name, counts, times))
+            paths[out_format].append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_path", type=str, help="Directory to write the data set to")
+    parser.add_argument("--files", type=int, default=100, help="Number of measurement files")
+    parser.add_argument("--formats", nargs="+", default=["spe"], choices=FORMATS, help="File formats to write")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator")
+    args = parser.parse_args()
+
+    dataset = generate_dataset(args.output_path, args.files, formats=args.formats, seed=args.seed)
+    print(f"Config: {dataset['config']}\nBackground: {dataset['background']}")
+    for data_format in args.formats:
+        print(f"{len(dataset[data_format])} .{data_format} files in {os.path.dirname(dataset[data_format][0])}")
@@ -0,0 +1,124 @@
+import numpy as np
+from detector_manager import Detector
+from gamma_spectrum import GammaSpectrum, get_sum_name
+from spectrum_stack import SpectrumStack
+
+"""
+Time-resolved sums over a shot.
+Cumulative counts and times are computed once, after which the sum over any range of files,
+or a whole set of rolling windows, is a difference of two rows.
+"""
+
+
+class ShotTimeSeries:
+    """
+    Cumulative counts and times of a time-ordered series of spectra of one detector
+    """
+    __slots__ = ("detector", "names", "file_numbers", "headers", "footers", "cumulative_counts",
+                 "cumulative_times")
+
+    def __init__(self, counts: np.ndarray, times: np.ndarray, names: list[str], detector: Detector,
+                 headers: list[bytes], footers: list[bytes], file_numbers=None):
+        """
+        :param counts: (n_spectra x channels) counts in time order
+        :param times: (n_spectra x 2) live and real times
+        :param names: Spectrum names
+        :param detector: The detector of the spectra
+        :param headers: Raw .Spe headers of the spectra
+        :param footers: Raw .Spe footers of the spectra
+        :param file_numbers: File numbers used to select windows (default: 1, 2, ...)
+        """
+        n_spectra, channels = counts.shape
+        self.detector = detector
+        self.names = names
+        self.headers = headers
+        self.footers = footers
+        self.file_numbers = np.arange(1, n_spectra + 1) if file_numbers is None else np.asarray(file_numbers)
+
+        self.cumulative_counts = np.zeros((n_spectra + 1, channels), dtype=GammaSpectrum.SUM_DTYPE)
+        np.cumsum(counts, axis=0, dtype=GammaSpectrum.SUM_DTYPE, out=self.cumulative_counts[1:])
+        self.cumulative_times = np.zeros((n_spectra + 1, 2), dtype=np.int64)
+        np.cumsum(times, axis=0, out=self.cumulative_times[1:])
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def from_stack(stack: SpectrumStack) -> "ShotTimeSeries":
+        return ShotTimeSeries(stack.counts, stack.times, stack.names, stack.detector, stack.headers, stack.footers,
+                              stack.file_numbers)
+
+    @staticmethod
+    def from_spectra(spectra: list[GammaSpectrum]) -> "ShotTimeSeries":
+        """
+        :param spectra: Time-ordered .Spe spectra of one detector
+        """
+        counts = np.zeros((len(spectra), len(spectra[0].counts)), dtype=GammaSpectrum.SUM_DTYPE)
+        for row, spectrum in zip(counts, spectra):
+            row[:] = spectrum.counts
+        return ShotTimeSeries(counts, np.stack([sp.times for sp in spectra]), [sp.name for sp in spectra],
+                              spectra[0].detector, [sp.header for sp in spectra], [sp.footer for sp in spectra])
+
+    def get_indices(self, start=None, end=None) -> (int, int):
+        """
+        Converts a range of file numbers (both inclusive) into the first and one-past-last row
+        """
+        first = 0 if start is None else int(np.searchsorted(self.file_numbers, start, side="left"))
+        last = len(self) if end is None else int(np.searchsorted(self.file_numbers, end, side="right"))
+        if first >= last:
+            raise ValueError(f"No spectra between {start} and {end}")
+        return first, last
+
+    def window(self, start=None, end=None) -> (np.ndarray, np.ndarray):
+        """
+        Summed counts and times of the files numbered start to end (both inclusive)
+        :return: counts, [live_time, real_time]
+        """
+        first, last = self.get_indices(start, end)
+        return (self.cumulative_counts[last] - self.cumulative_counts[first],
+                self.cumulative_times[last] - self.cumulative_times[first])
+
+    def rolling(self, width: int, stride=1) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Sums of all windows of width consecutive files, starting every stride files
+        :return: first rows of the windows, (n_windows x channels) counts, (n_windows x 2) times
+        """
+        if width < 1 or stride < 1:
+            raise ValueError("width and stride should be positive")
+        starts = np.arange(0, len(self) - width + 1, stride)
+        return (starts,
+                self.cumulative_counts[starts + width] - self.cumulative_counts[starts],
+                self.cumulative_times[starts + width] - self.cumulative_times[starts])
+
+    def _make_spectrum(self, first: int, last: int, counts: np.ndarray, times: np.ndarray,
+                       name_modifier: str) -> GammaSpectrum:
+        result = GammaSpectrum()
+        result.header = self.headers[first]
+        result.footer = self.footers[first]
+        result.detector = self.detector
+        result.counts = counts
+        result.times = times
+        result.update_times(times)
+        result.name = get_sum_name(self.detector, name_modifier, self.names[first], self.names[last - 1])
+        result.file_extension = ".Spe"
+        result.length = len(counts)
+        result.fill_channels()
+        result.fill_energies()
+        return result
+
+    def window_spectrum(self, start=None, end=None, name_modifier="") -> GammaSpectrum:
+        """
+        The sum of the files numbered start to end as a GammaSpectrum, named and ready for save_spe
+        like the result of SpectrumProcessor.sum_spectra
+        """
+        first, last = self.get_indices(start, end)
+        counts, times = self.window(start, end)
+        return self._make_spectrum(first, last, counts, times, name_modifier)
+
+    def rolling_spectra(self, width: int, stride=1, name_modifier="") -> list[GammaSpectrum]:
+        """
+        The rolling window sums (see rolling) as GammaSpectra, ready for save_spe
+        """
+        starts, counts, times = self.rolling(width, stride)
+        return [self._make_spectrum(first, first + width, row_counts, row_times, name_modifier)
+                for first, row_counts, row_times in zip(starts, counts, times)]